@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks admonition_templates and subfig on a synthetic book.
+
+The corpus is the real book scaled up: its chapter, admonition template,
+canned admonition, figmatrix and subfigure counts are counted in src/ and
+multiplied by --scale, unless given explicitly. Every chapter has sections of
+text, admonitions made from the templates (some of which hold references, whose
+resolution depends on the document), and figure matrices whose subfigures are
+referenced by :numref:.
+
+Each builder runs in a fresh process, which reads the corpus from scratch, then
+writes it. The read phase ends when the environment is updated. Throughput is
+reported in documents and doctree nodes per second, with the peak resident
+memory of the process. Results are saved as JSON named after the commit, in
+_build_cache/benchmarks by default, and can be compared with an earlier run
+using --compare.
+
+Usage: benchmarks/extensions.py [--scale N] [-b BUILDER]... [--compare RESULTS]
+"""
+
+import argparse
+import io
+import json
+import os
+import pathlib
+import platform
+import re
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import sphinx
+
+project_root = pathlib.Path(__file__).resolve().parent.parent
+source_dir = project_root / "src"
+sys.path.insert(0, str(source_dir))
+
+import gitversion
+
+BUILDERS = ["html", "singlehtml", "latex"]
+default_results_dir = project_root / "_build_cache" / "benchmarks"
+
+SECTIONS_PER_CHAPTER = 4
+PARAGRAPHS_PER_SECTION = 3
+# one template out of this many references a chapter
+REFERENCE_EVERY = 3
+
+CONF_TEMPLATE = """\
+import sys
+sys.path.insert(0, {source_dir!r})
+
+project = "Benchmark"
+master_doc = "index"
+extensions = ["admonition_templates", "subfig"]
+numfig = True
+numfig_secnum_depth = 2
+numfig_format = {{"figure": "Figure %s", "subfigure": "Figure %s"}}
+latex_documents = [("index", "benchmark.tex", "Benchmark", "Benchmark", "manual")]
+"""
+
+LOREM = ("Block ciphers are keyed permutations of a fixed size block, and their "
+         "modes of operation turn them into encryption schemes for arbitrary "
+         "messages, with very different security properties.")
+
+
+def count_in_book(pattern):
+    return sum(len(re.findall(pattern, path.read_text())) for path in source_dir.glob("*.rst"))
+
+
+def book_counts():
+    """the sizes of the real book, which the corpus is scaled from"""
+    figmatrices = count_in_book(r"\.\. figmatrix::")
+    return {
+        "chapters": len(list(source_dir.glob("*.rst"))),
+        "templates": count_in_book(r"\.\. declare_admonition::"),
+        "uses": count_in_book(r"\.\. canned_admonition::"),
+        "figmatrices": figmatrices,
+        "subfigures": max(1, count_in_book(r"\.\. subfigure::") // max(1, figmatrices)),
+    }
+
+
+def png_pixel():
+    """a 1x1 white PNG, for the subfigures to point to"""
+    def chunk(chunk_type, data):
+        return (struct.pack(">I", len(data)) + chunk_type + data
+                + struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"\0\xff\xff\xff"))
+            + chunk(b"IEND", b""))
+
+
+def indent(text, prefix="   "):
+    return "\n".join(prefix + line if line else line for line in text.splitlines())
+
+
+def template_text(template):
+    body = "Template %d: %s" % (template, LOREM)
+    if template % REFERENCE_EVERY == 0:
+        body += " See :ref:`chapter-0`."
+    return (".. declare_admonition::\n"
+            "   :name: template-%d\n"
+            "   :type: note\n\n%s\n" % (template, indent(body)))
+
+
+def use_text(use, templates):
+    return (".. canned_admonition::\n"
+            "   :from_template: template-%d\n\n"
+            "   Use %d. %s\n" % (use % templates, use, LOREM))
+
+
+def figmatrix_text(figmatrix, subfigures):
+    lines = [".. figmatrix::", "   :label: figmatrix-%d" % figmatrix,
+             "   :width: %.2f" % (1 / min(subfigures, 4) - 0.02), ""]
+    for subfigure in range(subfigures):
+        lines.extend([
+            "   .. _subfigure-%d-%d:" % (figmatrix, subfigure),
+            "   .. subfigure:: pixel.png",
+            "      :alt: Subfigure %d" % subfigure,
+            "",
+            "      Subfigure %d of matrix %d." % (subfigure, figmatrix),
+            "",
+        ])
+    lines.append("   Figure matrix %d." % figmatrix)
+    lines.append("")
+    references = ", ".join(":numref:`subfigure-%d-%d`" % (figmatrix, subfigure)
+                           for subfigure in range(subfigures))
+    lines.append("The subfigures are %s." % references)
+    return "\n".join(lines) + "\n"
+
+
+def spread(count, chapters):
+    """split range(count) into chapters, round robin"""
+    return [list(range(chapter, count, chapters)) for chapter in range(chapters)]
+
+
+def generate_corpus(corpus_dir, chapters, templates, uses, figmatrices, subfigures):
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    (corpus_dir / "conf.py").write_text(CONF_TEMPLATE.format(source_dir=str(source_dir)))
+    (corpus_dir / "pixel.png").write_bytes(png_pixel())
+
+    names = ["chapter-%d" % chapter for chapter in range(chapters)]
+    (corpus_dir / "index.rst").write_text(
+        "Benchmark\n=========\n\n.. toctree::\n   :numbered:\n\n%s\n"
+        % "\n".join("   " + name for name in names))
+
+    chapter_templates = spread(templates, chapters)
+    chapter_uses = spread(uses, chapters)
+    chapter_figmatrices = spread(figmatrices, chapters)
+    for chapter, name in enumerate(names):
+        title = "Chapter %d" % chapter
+        parts = [".. _%s:\n\n%s\n%s\n" % (name, title, "=" * len(title))]
+        # templates are declared before being used, as in the book
+        parts.extend(template_text(template) for template in chapter_templates[chapter])
+
+        blocks = ([use_text(use, max(1, templates)) for use in chapter_uses[chapter] if templates]
+                  + [figmatrix_text(figmatrix, subfigures)
+                     for figmatrix in chapter_figmatrices[chapter]])
+        per_section = spread(len(blocks), SECTIONS_PER_CHAPTER)
+        for section in range(SECTIONS_PER_CHAPTER):
+            heading = "Section %d.%d" % (chapter, section)
+            parts.append("%s\n%s\n" % (heading, "-" * len(heading)))
+            parts.extend(LOREM + "\n" for _ in range(PARAGRAPHS_PER_SECTION))
+            parts.extend(blocks[block] for block in per_section[section])
+        (corpus_dir / (name + ".rst")).write_text("\n".join(parts))
+    return len(names) + 1
+
+
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in kilobytes on linux, but bytes on macos
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_builder(corpus_dir, builder, work_dir):
+    """build the corpus from scratch in this process, returning the measurements"""
+    from sphinx.application import Sphinx
+
+    warnings = io.StringIO()
+    times = {}
+    app = Sphinx(str(corpus_dir), str(corpus_dir), str(work_dir / builder),
+                 str(work_dir / ("doctrees-" + builder)), builder,
+                 status=None, warning=warnings, freshenv=True)
+
+    def end_of_read(app, env):
+        times["read_end"] = time.perf_counter()
+
+    app.connect("env-updated", end_of_read)
+
+    start = time.perf_counter()
+    app.build(force_all=True)
+    end = time.perf_counter()
+
+    env = app.env
+    nodes = sum(sum(1 for _node in env.get_doctree(docname).traverse())
+                for docname in env.found_docs)
+    return {
+        "builder": builder,
+        "documents": len(env.found_docs),
+        "nodes": nodes,
+        "read": times["read_end"] - start,
+        "write": end - times["read_end"],
+        "peak_rss": peak_rss(),
+        "warnings": warnings.getvalue().count("WARNING"),
+    }
+
+
+def run_isolated(corpus_dir, builder, work_dir):
+    """run_builder in a new process, so that its peak memory is its own"""
+    output = subprocess.check_output([sys.executable, __file__, "run", str(corpus_dir), builder,
+                                      str(work_dir)], cwd=project_root)
+    return json.loads(output)
+
+
+def throughput(result, phase):
+    return {
+        "docs_per_s": result["documents"] / result[phase],
+        "nodes_per_s": result["nodes"] / result[phase],
+    }
+
+
+def summarize(result):
+    for phase in ("read", "write"):
+        result[phase + "_throughput"] = throughput(result, phase)
+    return result
+
+
+def format_table(results):
+    lines = ["%-11s %8s %9s %11s %8s %9s %11s %9s" % (
+        "builder", "read", "docs/s", "nodes/s", "write", "docs/s", "nodes/s", "peak")]
+    for result in results:
+        read, write = result["read_throughput"], result["write_throughput"]
+        lines.append("%-11s %7.2fs %9.1f %11.0f %7.2fs %9.1f %11.0f %6.0fMiB" % (
+            result["builder"], result["read"], read["docs_per_s"], read["nodes_per_s"],
+            result["write"], write["docs_per_s"], write["nodes_per_s"],
+            result["peak_rss"] / 2 ** 20))
+    return "\n".join(lines)
+
+
+def format_comparison(results, sizes, baseline):
+    """the ratio of every time and peak memory to the baseline, above 1 being slower"""
+    by_builder = {result["builder"]: result for result in baseline["results"]}
+    lines = ["compared to %s:" % baseline["version"]]
+    if baseline["sizes"] != sizes:
+        lines.append("warning: the corpus sizes differ, %s" % baseline["sizes"])
+    for result in results:
+        base = by_builder.get(result["builder"])
+        if base is None:
+            continue
+        lines.append("%-11s read x%.2f, write x%.2f, peak x%.2f" % (
+            result["builder"], result["read"] / base["read"], result["write"] / base["write"],
+            result["peak_rss"] / base["peak_rss"]))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["run"]:
+        corpus_dir, builder, work_dir = argv[1:]
+        json.dump(run_builder(pathlib.Path(corpus_dir), builder, pathlib.Path(work_dir)),
+                  sys.stdout)
+        return 0
+
+    counts = book_counts()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", type=int, default=10,
+                        help="how many times larger than the book the corpus is, defaults to 10")
+    for name, help_text in (("chapters", "number of chapters"),
+                            ("templates", "number of declare_admonition templates"),
+                            ("uses", "number of canned_admonition uses"),
+                            ("figmatrices", "number of figmatrix blocks")):
+        parser.add_argument("--" + name, type=int, default=None,
+                            help="%s, defaults to %d times the scale" % (help_text, counts[name]))
+    parser.add_argument("--subfigures", type=int, default=counts["subfigures"],
+                        help="number of subfigures per figmatrix, defaults to %(default)s")
+    parser.add_argument("-b", "--builder", dest="builders", action="append", choices=BUILDERS,
+                        help="builder to run, can be repeated, defaults to all of them")
+    parser.add_argument("-r", "--repeat", type=int, default=1,
+                        help="run every builder this many times, keeping the fastest run")
+    parser.add_argument("--results-dir", type=pathlib.Path, default=default_results_dir,
+                        help="where results are saved, defaults to %(default)s")
+    parser.add_argument("--compare", type=pathlib.Path, metavar="RESULTS",
+                        help="results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    sizes = {name: getattr(args, name) if getattr(args, name) is not None
+             else counts[name] * args.scale
+             for name in ("chapters", "templates", "uses", "figmatrices")}
+    sizes["subfigures"] = args.subfigures
+
+    # read before the results of this run may replace it
+    baseline = None
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="crypto101-benchmark-") as tmp:
+        corpus_dir = pathlib.Path(tmp) / "corpus"
+        documents = generate_corpus(corpus_dir, **sizes)
+        print("corpus: %d documents, %s" % (documents, ", ".join(
+            "%d %s" % (value, name) for name, value in sizes.items())), flush=True)
+
+        for builder in args.builders or BUILDERS:
+            runs = [run_isolated(corpus_dir, builder, pathlib.Path(tmp) / ("run-%d" % run))
+                    for run in range(args.repeat)]
+            best = min(runs, key=lambda result: result["read"] + result["write"])
+            best["peak_rss"] = max(result["peak_rss"] for result in runs)
+            results.append(summarize(best))
+
+    version, _release = gitversion.get_version()
+    report = {
+        "version": version,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sphinx": sphinx.__version__,
+        "sizes": sizes,
+        "results": results,
+    }
+    args.results_dir.mkdir(parents=True, exist_ok=True)
+    results_path = args.results_dir / ("extensions-%s.json" % version)
+    results_path.write_text(json.dumps(report, indent=2) + "\n")
+
+    print(format_table(results))
+    if any(result["warnings"] for result in results):
+        print("warnings: %s" % ", ".join("%s %d" % (result["builder"], result["warnings"])
+                                         for result in results))
+    if baseline is not None:
+        print(format_comparison(results, sizes, baseline))
+    print("results saved to %s" % os.path.relpath(results_path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the sharded search index against the stock one.
+
+Reads an html build made with search_shards, in _build_en/html by default: its
+.searchindex.js is the index Sphinx would otherwise serve, and searchindex.js
+the manifest of the shards in _search/. For every query, the stock search
+fetches and parses the whole index, while the sharded one fetches and parses
+the manifest, and the shards of the query words and of their stems.
+
+Sizes are reported raw and gzipped, as served by deploy.py. Time to the first
+result is modelled as the transfer of the gzipped files over a link of
+--bandwidth kbit/s, after one round trip of --rtt ms: the search page gets its
+query in its address, so the shards are fetched along with the manifest. The
+time Python takes to parse the files as JSON and look the terms up stands for
+the time browsers take. Results are saved as JSON named after the commit, in
+_build_cache/benchmarks by default.
+
+Usage: benchmarks/search_index.py [--html-dir DIR] [--bandwidth KBITS] [--rtt MS]
+                                  [--language LANG] [QUERY...]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import pathlib
+import platform
+import sys
+import time
+
+import sphinx
+from sphinx.search import js_index, languages
+
+project_root = pathlib.Path(__file__).resolve().parent.parent
+source_dir = project_root / "src"
+sys.path.insert(0, str(source_dir))
+
+import gitversion
+import search_shards
+
+default_html_dir = project_root / "_build_en" / "html"
+default_results_dir = project_root / "_build_cache" / "benchmarks"
+
+QUERIES = [
+    "xor",
+    "block cipher",
+    "diffie hellman key exchange",
+    "message authentication code",
+    "stream cipher nonce reuse",
+    "public key encryption",
+]
+# times every parse is repeated, keeping the fastest
+REPEAT = 5
+
+
+class ScriptFile:
+    """a file of the index, which calls a function of the Search object"""
+    def __init__(self, path):
+        self.path = path
+        self.data = path.read_bytes()
+        self.gzip_size = len(gzip.compress(self.data, 9, mtime=0))
+        text = self.data.decode()
+        self.arguments = "[%s]" % text[text.index("(") + 1:text.rindex(")")]
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def parse(self):
+        """the arguments of the call, and the fastest time taken to parse them"""
+        best = None
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            value = json.loads(self.arguments)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return value, best
+
+
+class FullIndexFile(ScriptFile):
+    """the stock index, whose keys are only quoted as JSON since Sphinx 6"""
+    def __init__(self, path):
+        super().__init__(path)
+        index = js_index.loads(self.data.decode())
+        # parsed as the JSON of the same data, as the shards are
+        self.arguments = json.dumps([index], separators=(",", ":"))
+
+
+def query_terms(language, query):
+    """the stemmed words the search looks up, as searchtools.js does"""
+    terms = []
+    for word in query.lower().split():
+        if word in language.stopwords:
+            continue
+        stem = language.stem(word)
+        terms.append(word if len(stem) < 3 and len(word) >= 3 else stem)
+    return terms
+
+
+def shard_prefixes(language, query, prefix_length):
+    """the prefixes search_shards.js loads: the ones of the words, and of their stems"""
+    return {term[:prefix_length] for word in query.lower().split()
+            for term in (word, language.stem(word))}
+
+
+def look_up(index, terms):
+    """the documents matching every term, and the time taken to find them"""
+    start = time.perf_counter()
+    documents = None
+    for term in terms:
+        found = set()
+        for key in ("terms", "titleterms"):
+            matches = index[key].get(term, [])
+            found.update(matches if isinstance(matches, list) else [matches])
+        documents = found if documents is None else documents & found
+    return documents or set(), time.perf_counter() - start
+
+
+def transfer_time(size, round_trips, bandwidth, rtt):
+    return round_trips * rtt + size * 8 / bandwidth
+
+
+def measure(html_dir, language, queries, bandwidth, rtt):
+    full_index = FullIndexFile(html_dir / search_shards.FULL_INDEX_FILENAME)
+    manifest_file = ScriptFile(html_dir / "searchindex.js")
+    (manifest,), manifest_parse = manifest_file.parse()
+    prefix_length = manifest["shardprefixlength"]
+    shards_dir = html_dir / search_shards.SHARDS_DIR
+    shards = {prefix: ScriptFile(shards_dir / search_shards.shard_filename(prefix))
+              for prefix in manifest["shards"]}
+
+    results = []
+    for query in queries:
+        terms = query_terms(language, query)
+
+        (stock_index,), stock_parse = full_index.parse()
+        stock_documents, stock_lookup = look_up(stock_index, terms)
+        stock = {
+            "files": 1,
+            "size": full_index.size,
+            "gzip_size": full_index.gzip_size,
+            "parse": stock_parse,
+            "lookup": stock_lookup,
+        }
+
+        prefixes = shard_prefixes(language, query, prefix_length) & shards.keys()
+        sharded_index = {"terms": {}, "titleterms": {}}
+        shards_parse = 0
+        for prefix in prefixes:
+            (_prefix, _digest, shard), parse = shards[prefix].parse()
+            shards_parse += parse
+            for key in ("terms", "titleterms"):
+                sharded_index[key].update(shard[key])
+        sharded_documents, sharded_lookup = look_up(sharded_index, terms)
+        if sharded_documents != stock_documents:
+            raise RuntimeError("the sharded index finds other documents for %r" % query)
+        sharded = {
+            "files": 1 + len(prefixes),
+            "size": manifest_file.size + sum(shards[prefix].size for prefix in prefixes),
+            "gzip_size": (manifest_file.gzip_size
+                          + sum(shards[prefix].gzip_size for prefix in prefixes)),
+            "parse": manifest_parse + shards_parse,
+            "lookup": sharded_lookup,
+        }
+
+        stock["first_result"] = (transfer_time(stock["gzip_size"], 1, bandwidth, rtt)
+                                 + stock["parse"] + stock["lookup"])
+        # the shards are fetched at the same time as the manifest
+        sharded["first_result"] = (transfer_time(sharded["gzip_size"], 1, bandwidth, rtt)
+                                   + sharded["parse"] + sharded["lookup"])
+        results.append({"query": query, "documents": len(stock_documents),
+                        "stock": stock, "sharded": sharded})
+
+    sizes = {
+        "stock": {"size": full_index.size, "gzip_size": full_index.gzip_size},
+        "sharded": {
+            "shards": len(shards),
+            "size": manifest_file.size + sum(shard.size for shard in shards.values()),
+            "gzip_size": (manifest_file.gzip_size
+                          + sum(shard.gzip_size for shard in shards.values())),
+            "manifest_size": manifest_file.size,
+            "manifest_gzip_size": manifest_file.gzip_size,
+        },
+    }
+    return sizes, results
+
+
+def format_sizes(sizes):
+    stock, sharded = sizes["stock"], sizes["sharded"]
+    return "\n".join([
+        "stock index: %.1fKiB, %.1fKiB gzipped" % (stock["size"] / 1024,
+                                                   stock["gzip_size"] / 1024),
+        "sharded index: %d shards, %.1fKiB, %.1fKiB gzipped, of which the manifest "
+        "%.1fKiB, %.1fKiB gzipped" % (
+            sharded["shards"], sharded["size"] / 1024, sharded["gzip_size"] / 1024,
+            sharded["manifest_size"] / 1024, sharded["manifest_gzip_size"] / 1024),
+    ])
+
+
+def format_table(results):
+    lines = ["%-30s %5s %16s %16s %17s" % (
+        "query", "docs", "files", "gzipped KiB", "first result ms")]
+    lines.append("%-30s %5s %7s %8s %7s %8s %8s %8s" % (
+        "", "", "stock", "sharded", "stock", "sharded", "stock", "sharded"))
+    for result in results:
+        stock, sharded = result["stock"], result["sharded"]
+        lines.append("%-30s %5d %7d %8d %7.1f %8.1f %8.1f %8.1f" % (
+            result["query"], result["documents"], stock["files"], sharded["files"],
+            stock["gzip_size"] / 1024, sharded["gzip_size"] / 1024,
+            stock["first_result"] * 1000, sharded["first_result"] * 1000))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--html-dir", type=pathlib.Path, default=default_html_dir,
+                        help="an html build made with search_shards, defaults to %(default)s")
+    parser.add_argument("--bandwidth", type=float, default=1600,
+                        help="link bandwidth in kbit/s, defaults to %(default)s")
+    parser.add_argument("--rtt", type=float, default=150,
+                        help="round trip time in ms, defaults to %(default)s")
+    parser.add_argument("--language", default="en", choices=sorted(languages),
+                        help="language of the book, whose stemmer is used, defaults to %(default)s")
+    parser.add_argument("--results-dir", type=pathlib.Path, default=default_results_dir,
+                        help="where results are saved, defaults to %(default)s")
+    parser.add_argument("queries", metavar="QUERY", nargs="*",
+                        help="queries to run, defaults to a few of the book's topics")
+    args = parser.parse_args(argv)
+
+    if not args.html_dir.is_dir():
+        print("%s doesn't exist, build the html first" % args.html_dir, file=sys.stderr)
+        return 1
+    if not (args.html_dir / search_shards.FULL_INDEX_FILENAME).is_file():
+        print("%s wasn't built with search_shards" % args.html_dir, file=sys.stderr)
+        return 1
+
+    language = languages[args.language]({})
+    sizes, results = measure(args.html_dir, language, args.queries or QUERIES,
+                             args.bandwidth * 1000, args.rtt / 1000)
+
+    version, _release = gitversion.get_version()
+    report = {
+        "version": version,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sphinx": sphinx.__version__,
+        "bandwidth": args.bandwidth,
+        "rtt": args.rtt,
+        "sizes": sizes,
+        "results": results,
+    }
+    args.results_dir.mkdir(parents=True, exist_ok=True)
+    results_path = args.results_dir / ("search-index-%s.json" % version)
+    results_path.write_text(json.dumps(report, indent=2) + "\n")
+
+    print(format_sizes(sizes))
+    print(format_table(results))
+    print("results saved to %s" % os.path.relpath(results_path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
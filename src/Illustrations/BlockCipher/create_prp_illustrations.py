@@ -1,64 +1,207 @@
-from __future__ import division
-from random import Random, shuffle
+#!/usr/bin/env python3
 
-random = Random(0xdeadbeef).random
+"""
+Draws the permutation illustrations of the block cipher chapter as SVG.
+
+A block cipher with a given key is a permutation of all the possible blocks.
+Blocks are drawn as nodes on a circle, colored by value, and a permutation as
+arrows from every block to its image:
+
+ - AllNodes: the blocks alone
+ - Encryption: a random permutation
+ - Decryption: its inverse
+ - Encryption2: another random permutation, as with another key
+ - Composed: Encryption2 applied after Encryption
+
+The default parameters draw the illustrations of the book, which were first
+laid out by neato: the permutations are the ones shuffled by the original
+Python 2 script from the same seed.
+"""
+
+import argparse
+import colorsys
+import math
+import pathlib
+from random import Random
+
+VARIANTS = ["AllNodes", "Encryption", "Decryption", "Encryption2", "Composed"]
+BOOK_VARIANTS = VARIANTS[:4]
+DEFAULT_SEED = 0xdeadbeef
+
+NODE_RADIUS = 18
+# space between nodes along the circle
+NODE_SPACING = 24
+MARGIN = 8
+# how far arrows bend towards the center, from 0 for straight lines to 1
+CURVATURE = 0.5
+FONT = 'font-family="Times,serif" font-size="14"'
+
+
+def shuffle(items, random):
+    """random.shuffle(items, random) of Python 2, which Python 3 doesn't offer anymore"""
+    for i in reversed(range(1, len(items))):
+        j = int(random() * (i + 1))
+        items[i], items[j] = items[j], items[i]
 
-def unirange(n):
+
+def random_permutation(size, random):
     """
-    Return n equidistant points between 0 (inclusive) and 1 (not inclusive).
+    return a list mapping every block to its image. the original script shuffled
+    the node names and drew an arrow from shuffled[i] to i.
     """
-    return (i / n for i in xrange(n))
-
-#node_names = "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
-node_names = "0123456789ABCDEF"
-node_template = """{name} [fillcolor="{hue} {sat} {val}"];"""
-nodes = " ".join(node_template.format(name=name, hue=hue, sat=0.4, val=1)
-                 for name, hue in zip(node_names, unirange(len(node_names))))
-
-shuffled_names = list(node_names)
-shuffle(shuffled_names, random)
-
-shuffled_names_2 = list(node_names)
-shuffle(shuffled_names_2, random)
-
-def vertices(permutation, reverse=False):
-    if reverse:
-        pairs = zip(node_names, permutation)
-    else:
-        pairs = zip(permutation, node_names)
-
-    return " ".join("{0} -> {1};".format(*pair) for pair in pairs)
-
-graph_template = """
-digraph G {{
-    graph [splines=curved; layout=neato; start={start}; epsilon=0.001];
-    node [style=filled, shape=circle];
-    edge [{edge_style}];
-    {nodes}
-    {vertices}
-}}
-"""
+    shuffled = list(range(size))
+    shuffle(shuffled, random)
+    permutation = [0] * size
+    for target, source in enumerate(shuffled):
+        permutation[source] = target
+    return permutation
+
+
+def inverse(permutation):
+    result = [0] * len(permutation)
+    for source, target in enumerate(permutation):
+        result[target] = source
+    return result
+
+
+def node_names(size):
+    digits = max(1, len("%x" % (size - 1)))
+    return ["%0*X" % (digits, i) for i in range(size)]
+
+
+def node_color(index, size):
+    red, green, blue = colorsys.hsv_to_rgb(index / size, 0.4, 1)
+    return "#%02x%02x%02x" % (round(red * 255), round(green * 255), round(blue * 255))
+
+
+class Layout:
+    """nodes evenly spread on a circle, starting at the top, clockwise"""
+    def __init__(self, size):
+        self.size = size
+        self.radius = max(size * (2 * NODE_RADIUS + NODE_SPACING) / (2 * math.pi),
+                          2 * NODE_RADIUS)
+        # room for the nodes and the loops of blocks which are their own image
+        self.extent = self.radius + 3 * NODE_RADIUS + MARGIN
+        self.width = self.height = 2 * self.extent
+
+    def angle(self, index):
+        return 2 * math.pi * index / self.size - math.pi / 2
+
+    def position(self, index):
+        angle = self.angle(index)
+        return (self.extent + self.radius * math.cos(angle),
+                self.extent + self.radius * math.sin(angle))
+
+
+def towards(start, end, distance):
+    """the point at distance from start, on the way to end"""
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length = math.hypot(dx, dy) or 1
+    return start[0] + dx * distance / length, start[1] + dy * distance / length
+
+
+def arrow_path(layout, source, target):
+    if source == target:
+        # a loop outside of the circle
+        center = layout.position(source)
+        angle = layout.angle(source)
+        spread = 0.5
+        start = (center[0] + NODE_RADIUS * math.cos(angle - spread),
+                 center[1] + NODE_RADIUS * math.sin(angle - spread))
+        end = (center[0] + NODE_RADIUS * math.cos(angle + spread),
+               center[1] + NODE_RADIUS * math.sin(angle + spread))
+        reach = 3.5 * NODE_RADIUS
+        control1 = (center[0] + reach * math.cos(angle - 2 * spread),
+                    center[1] + reach * math.sin(angle - 2 * spread))
+        control2 = (center[0] + reach * math.cos(angle + 2 * spread),
+                    center[1] + reach * math.sin(angle + 2 * spread))
+        return "M %.2f %.2f C %.2f %.2f %.2f %.2f %.2f %.2f" % (
+            *start, *control1, *control2, *end)
+
+    # a quadratic curve bent towards the center of the circle. the ends of the
+    # curve point at its control point, which makes them leave and enter the
+    # nodes along their radius.
+    source_center = layout.position(source)
+    target_center = layout.position(target)
+    middle = ((source_center[0] + target_center[0]) / 2,
+              (source_center[1] + target_center[1]) / 2)
+    control = (middle[0] + (layout.extent - middle[0]) * CURVATURE,
+               middle[1] + (layout.extent - middle[1]) * CURVATURE)
+    start = towards(source_center, control, NODE_RADIUS)
+    end = towards(target_center, control, NODE_RADIUS)
+    return "M %.2f %.2f Q %.2f %.2f %.2f %.2f" % (*start, *control, *end)
+
+
+def render_svg(size, permutation=None):
+    """the SVG drawing of size blocks, and arrows for permutation if given"""
+    layout = Layout(size)
+    names = node_names(size)
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<svg xmlns="http://www.w3.org/2000/svg" width="%.0fpt" height="%.0fpt" '
+        'viewBox="0 0 %.2f %.2f">' % (layout.width, layout.height, layout.width, layout.height),
+        '<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" '
+        'markerWidth="7" markerHeight="7" orient="auto">'
+        '<path d="M 0 0 L 10 5 L 0 10 z"/></marker></defs>',
+        '<rect width="100%" height="100%" fill="white"/>',
+    ]
+
+    if permutation is not None:
+        lines.append('<g fill="none" stroke="black" marker-end="url(#arrow)">')
+        for source, target in enumerate(permutation):
+            lines.append('<path d="%s"/>' % arrow_path(layout, source, target))
+        lines.append('</g>')
+
+    lines.append('<g stroke="black" %s text-anchor="middle">' % FONT)
+    for index, name in enumerate(names):
+        x, y = layout.position(index)
+        lines.append('<circle cx="%.2f" cy="%.2f" r="%d" fill="%s"/>'
+                     % (x, y, NODE_RADIUS, node_color(index, size)))
+        lines.append('<text x="%.2f" y="%.2f" dy="0.35em" stroke="none">%s</text>'
+                     % (x, y, name))
+    lines.append('</g>')
+    lines.append('</svg>')
+    return "\n".join(lines) + "\n"
+
+
+def permutations(size, seed):
+    """the permutation of every variant, which all come from the same random stream"""
+    random = Random(seed).random
+    encryption = random_permutation(size, random)
+    encryption2 = random_permutation(size, random)
+    return {
+        "AllNodes": None,
+        "Encryption": encryption,
+        "Decryption": inverse(encryption),
+        "Encryption2": encryption2,
+        "Composed": [encryption2[block] for block in encryption],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bits", type=int, default=4,
+                        help="the block size in bits, making 2**BITS nodes, defaults to 4")
+    parser.add_argument("--seed", type=lambda value: int(value, 0), default=DEFAULT_SEED,
+                        help="seed of the permutations, defaults to %#x" % DEFAULT_SEED)
+    parser.add_argument("-o", "--output-dir", type=pathlib.Path,
+                        default=pathlib.Path(__file__).resolve().parent,
+                        help="where VARIANT.svg is written, defaults to the directory of this script")
+    parser.add_argument("variants", metavar="VARIANT", nargs="*",
+                        help="what to draw: %s, defaults to all of them but Composed"
+                        % ", ".join(VARIANTS))
+    args = parser.parse_args(argv)
+    unknown = [variant for variant in args.variants if variant not in VARIANTS]
+    if unknown:
+        parser.error("unknown variant: %s" % ", ".join(unknown))
+
+    size = 2 ** args.bits
+    variant_permutations = permutations(size, args.seed)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    for variant in args.variants or BOOK_VARIANTS:
+        path = args.output_dir / (variant + ".svg")
+        path.write_text(render_svg(size, variant_permutations[variant]))
+
 
-with open("AllNodes.dot", "w") as f:
-    f.write(graph_template.format(nodes=nodes,
-                                  vertices=vertices(node_names[1:] + node_names[0]),
-                                  edge_style="style=invis",
-                                  start=1))
-
-with open("Encryption.dot", "w") as f:
-    f.write(graph_template.format(nodes=nodes,
-                                  vertices=vertices(shuffled_names),
-                                  edge_style="",
-                                  start=5))
-
-with open("Decryption.dot", "w") as f:
-    f.write(graph_template.format(nodes=nodes,
-                                  vertices=vertices(shuffled_names, reverse=True),
-                                  edge_style="",
-                                  start=5))
-
-with open("Encryption2.dot", "w") as f:
-    f.write(graph_template.format(nodes=nodes,
-                                  vertices=vertices(shuffled_names_2),
-                                  edge_style="",
-                                  start=95))
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,413 @@
+#!/usr/bin/env python3
 
-from PIL import Image
-import itertools
-import random
+"""
+Makes the ECB illustrations: an image "encrypted" with a random code book.
+
+The pixels are split into chunks of CHUNK_SIZE consecutive pixels, in reading
+order, and every distinct chunk is replaced with a distinct chunk of random
+colors, the way a block cipher in ECB mode maps every distinct block of
+plaintext to the same block of ciphertext. Writes INPUT_CHUNKSIZE.png for every
+chunk size, then INPUT_random.png, an image of random colors of the same size.
+
+With --aes MODE, the RGB pixel buffer is also actually encrypted with AES in
+ECB, CBC or CTR mode, and written to INPUT_MODE.png. The key and IV depend on
+--seed, like the colors. This needs the cryptography package.
+Images are encrypted in strips of rows, which are read from the decoded image,
+encrypted through memoryviews into buffers allocated once, and compressed into
+the PNG as they come, so that only the source image and a few strips are ever
+held in memory, whatever the size of the image.
+
+`ecbdemo.py batch MANIFEST` makes all the images listed in a JSON manifest, such
+as ecb.json, which lists the illustrations of the book. Each input is decoded
+once, into shared memory which a pool of worker processes renders from. Images
+newer than their input and the manifest are skipped. The wall time and peak
+resident memory of every image is reported.
+"""
+
+import argparse
+import json
+import os
+import resource
+import struct
 import sys
 import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+AES_MODES = ["ecb", "cbc", "ctr"]
+AES_BLOCK_SIZE = 16
+AES_KEY_SIZE = 32
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def pixel_chunks(pixels, chunk_size):
+    """
+    return the (height * width, bands) array of pixels as an array of chunks,
+    each viewed as a single fixed-width byte record. the last chunk is padded
+    with black pixels.
+    """
+    padding = -len(pixels) % chunk_size
+    if padding:
+        pixels = np.concatenate([pixels, np.zeros((padding, pixels.shape[1]), pixels.dtype)])
+    rows = np.ascontiguousarray(pixels).reshape(-1, chunk_size * pixels.shape[1])
+    return rows.view(np.dtype((np.void, rows.shape[1]))).ravel()
+
+
+def make_code_book(rng, count, chunk_size):
+    """return count distinct chunks of random RGB colors"""
+    code_book = rng.integers(256, size=(count, chunk_size * 3), dtype=np.uint8)
+    while True:
+        records = code_book.view(np.dtype((np.void, code_book.shape[1]))).ravel()
+        _, first = np.unique(records, return_index=True)
+        if len(first) == count:
+            return code_book
+        # draw again the chunks which were already used by another one
+        duplicates = np.ones(count, dtype=bool)
+        duplicates[first] = False
+        code_book[duplicates] = rng.integers(256, size=(duplicates.sum(), chunk_size * 3),
+                                             dtype=np.uint8)
+
+
+def permute_pixels(pixels, chunk_size, rng):
+    """return the RGB image of the (height, width[, bands]) array of pixels"""
+    height, width = pixels.shape[:2]
+    pixels = pixels.reshape(width * height, -1)
+    _, inverse = np.unique(pixel_chunks(pixels, chunk_size), return_inverse=True)
+    inverse = inverse.ravel()
+    code_book = make_code_book(rng, inverse.max() + 1, chunk_size)
+    modified = code_book[inverse].reshape(-1, 3)[:width * height]
+    return Image.fromarray(modified.reshape(height, width, 3), "RGB")
+
+
+def permute_chunks(image, chunk_size, rng):
+    return permute_pixels(np.asarray(image), chunk_size, rng)
+
+
+def random_image(size, rng):
+    width, height = size
+    return Image.fromarray(rng.integers(256, size=(height, width, 3), dtype=np.uint8), "RGB")
+
+
+class PngWriter:
+    """
+    writes an 8 bit RGB PNG from a stream of pixel bytes, compressing every row as
+    soon as it is complete. bytes past the last row are ignored.
+    """
+    def __init__(self, fp, width, height):
+        self.fp = fp
+        self.rows_left = height
+        self.row = bytearray(width * 3)
+        self.row_fill = 0
+        self.compressor = zlib.compressobj()
+        fp.write(PNG_SIGNATURE)
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, chunk_type, data):
+        self.fp.write(struct.pack(">I", len(data)))
+        self.fp.write(chunk_type)
+        self.fp.write(data)
+        self.fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write(self, data):
+        compressed = []
+        with memoryview(data) as view:
+            while view and self.rows_left:
+                count = min(len(view), len(self.row) - self.row_fill)
+                self.row[self.row_fill:self.row_fill + count] = view[:count]
+                self.row_fill += count
+                view = view[count:]
+                if self.row_fill == len(self.row):
+                    # each row starts with its filter type, none
+                    compressed.append(self.compressor.compress(b"\0"))
+                    compressed.append(self.compressor.compress(self.row))
+                    self.row_fill = 0
+                    self.rows_left -= 1
+
+        data = b"".join(compressed)
+        if data:
+            self.write_chunk(b"IDAT", data)
+
+    def close(self):
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+
+
+def aes_encryptor(mode, key, iv):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    if mode == "ecb":
+        cipher_mode = modes.ECB()
+    elif mode == "cbc":
+        cipher_mode = modes.CBC(iv)
+    else:
+        cipher_mode = modes.CTR(iv)
+    return Cipher(algorithms.AES(key), cipher_mode).encryptor()
+
+
+def image_strips(image, strip_rows):
+    """the RGB pixels of image, strip_rows rows at a time"""
+    width, height = image.size
+    for top in range(0, height, strip_rows):
+        strip = image.crop((0, top, width, min(top + strip_rows, height)))
+        yield strip.convert("RGB").tobytes()
+
+
+def array_strips(pixels, strip_rows):
+    """the RGB pixels of a (height, width[, bands]) array, strip_rows rows at a time"""
+    for top in range(0, pixels.shape[0], strip_rows):
+        strip = pixels[top:top + strip_rows]
+        if strip.ndim == 3 and strip.shape[2] == 3 and strip.dtype == np.uint8:
+            # rows of a C-contiguous array are contiguous, this is no copy
+            yield memoryview(strip).cast("B")
+        else:
+            yield Image.fromarray(strip).convert("RGB").tobytes()
+
+
+def encrypt_image(image, mode, rng, filename, strip_rows=64):
+    """encrypt the RGB pixels of image with AES, writing the result to filename"""
+    width, height = image.size
+    encrypt_strips(image_strips(image, strip_rows), width, height, mode, rng, filename,
+                   strip_rows)
+
+
+def encrypt_strips(strips, width, height, mode, rng, filename, strip_rows):
+    encryptor = aes_encryptor(mode, rng.bytes(AES_KEY_SIZE), rng.bytes(AES_BLOCK_SIZE))
+
+    # block modes hold back incomplete blocks, so a strip can give up to a block more
+    encrypted = bytearray(strip_rows * width * 3 + AES_BLOCK_SIZE)
+    with open(filename, "wb") as fp, memoryview(encrypted) as out:
+        png = PngWriter(fp, width, height)
+        for strip in strips:
+            count = encryptor.update_into(strip, out)
+            png.write(out[:count])
+
+        # ECB and CBC only encrypt whole blocks: pad the last one with black pixels,
+        # the PNG writer drops what falls outside of the image
+        padding = -(width * height * 3) % AES_BLOCK_SIZE
+        if mode != "ctr" and padding:
+            count = encryptor.update_into(bytes(padding), out)
+            png.write(out[:count])
+        png.write(encryptor.finalize())
+        png.close()
+
+
+def seeded_rng(seed, *key):
+    """each image gets its own generator, so that it doesn't depend on the other ones"""
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, *key])
+
+
+Variant = namedtuple("Variant", "input output mode chunk_size seed")
+
+
+def load_manifest(manifest_path):
+    """
+    the manifest is a list of jobs such as:
+
+        {"input": "Plaintext.png", "mode": "codebook", "chunk_sizes": [5, 30],
+         "seed": 1, "output": "Ciphertext{variant}.png"}
+
+    mode is codebook, which makes an image per chunk size, random, or an AES mode.
+    the output defaults to INPUT_{variant}.png, where the variant is the chunk size
+    or the mode, as for single images. paths are relative to the manifest.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path) as fp:
+        jobs = json.load(fp)
+
+    variants = []
+    for job in jobs:
+        input_path = os.path.normpath(os.path.join(base_dir, job["input"]))
+        mode = job.get("mode", "codebook")
+        output = job.get("output", job["input"] + "_{variant}.png")
+        if mode == "codebook":
+            chunk_sizes = job["chunk_sizes"]
+        elif mode == "random" or mode in AES_MODES:
+            chunk_sizes = [None]
+        else:
+            raise ValueError("unknown mode {!r} in {}".format(mode, manifest_path))
+
+        for chunk_size in chunk_sizes:
+            name = output.format(variant=mode if chunk_size is None else chunk_size)
+            output_path = os.path.normpath(os.path.join(base_dir, name))
+            variants.append(Variant(input_path, output_path, mode, chunk_size, job.get("seed")))
+    return variants
+
+
+def is_up_to_date(variant, manifest_path):
+    try:
+        output_mtime = os.stat(variant.output).st_mtime
+    except OSError:
+        return False
+    return output_mtime >= max(os.stat(variant.input).st_mtime, os.stat(manifest_path).st_mtime)
+
+
+def reset_peak_rss():
+    """reset the peak resident memory of this process, on linux"""
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """the peak resident memory of this process in bytes, since the last reset on linux"""
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # in kilobytes on linux, but bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def share_pixels(pixels):
+    """copy an array to a new shared memory block, returning the block and its descriptor"""
+    block = shared_memory.SharedMemory(create=True, size=max(pixels.nbytes, 1))
+    np.ndarray(pixels.shape, pixels.dtype, buffer=block.buf)[...] = pixels
+    return block, (block.name, pixels.shape, pixels.dtype.str)
+
+
+# shared memory blocks attached by this worker process, by name
+attached_blocks = {}
+
+
+def attach_pixels(descriptor):
+    name, shape, dtype = descriptor
+    block = attached_blocks.get(name)
+    if block is None:
+        block = shared_memory.SharedMemory(name=name)
+        attached_blocks[name] = block
+    return np.ndarray(shape, dtype, buffer=block.buf)
+
+
+def render_variant(variant, descriptor, strip_rows):
+    """render a variant from shared pixels, returning its wall time and peak memory"""
+    reset_peak_rss()
+    start = time.perf_counter()
+    pixels = attach_pixels(descriptor)
+    height, width = pixels.shape[:2]
+    # never leave a partial image behind, which would look up to date
+    tmp_output = variant.output + ".tmp"
+    if variant.mode == "codebook":
+        rng = seeded_rng(variant.seed, variant.chunk_size)
+        permute_pixels(pixels, variant.chunk_size, rng).save(tmp_output, format="PNG")
+    elif variant.mode == "random":
+        random_image((width, height), seeded_rng(variant.seed)).save(tmp_output, format="PNG")
+    else:
+        rng = seeded_rng(variant.seed, 0, AES_MODES.index(variant.mode))
+        encrypt_strips(array_strips(pixels, strip_rows), width, height, variant.mode, rng,
+                       tmp_output, strip_rows)
+    os.replace(tmp_output, variant.output)
+    return time.perf_counter() - start, peak_rss()
+
+
+def batch(manifest_path, jobs=None, force=False, strip_rows=64):
+    variants = load_manifest(manifest_path)
+    pending = [variant for variant in variants
+               if force or not is_up_to_date(variant, manifest_path)]
+    print("{} images, {} up to date".format(len(variants), len(variants) - len(pending)))
+    if not pending:
+        return 0
+
+    blocks = []
+    failures = 0
+    try:
+        # decode every input once, in the main process
+        descriptors = {}
+        for input_path in sorted({variant.input for variant in pending}):
+            with Image.open(input_path) as image:
+                block, descriptors[input_path] = share_pixels(np.asarray(image))
+            blocks.append(block)
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(render_variant, variant, descriptors[variant.input],
+                                       strip_rows): variant
+                       for variant in pending}
+            for future in as_completed(futures):
+                variant = futures[future]
+                name = os.path.relpath(variant.output)
+                try:
+                    wall_time, rss = future.result()
+                except Exception as exc:
+                    print("{}: failed: {}".format(name, exc), file=sys.stderr)
+                    failures += 1
+                    continue
+                print("{}: {:.2f}s, peak RSS {:.1f} MiB".format(name, wall_time, rss / 2 ** 20))
+        print("Done in {:.2f}s".format(time.perf_counter() - start))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    if failures:
+        return 1
+    return 0
 
 
-def grouper(n, iterable):
-    args = [iter(iterable)] * n
-    return itertools.izip_longest(fillvalue=(0, 0, 0), *args)
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog="ecbdemo.py batch",
+                                     description="Makes all the images listed in a manifest.")
+    parser.add_argument("manifest", metavar="MANIFEST")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes, defaults to the cpu count")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="make the images which are up to date too")
+    parser.add_argument("--strip-rows", type=int, default=64,
+                        help="number of rows encrypted at a time, defaults to %(default)s")
+    args = parser.parse_args(argv)
+    return batch(args.manifest, args.jobs, args.force, args.strip_rows)
 
 
-def random_color():
-    return tuple(random.randrange(256) for _ in xrange(3))
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["batch"]:
+        return batch_main(argv[1:])
 
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input_filename", metavar="INPUT")
+    parser.add_argument("chunk_sizes", metavar="CHUNK_SIZE", type=int, nargs="*")
+    parser.add_argument("--aes", dest="aes_modes", metavar="MODE", action="append",
+                        choices=AES_MODES, default=[],
+                        help="also encrypt the image with AES in MODE, can be repeated")
+    parser.add_argument("--strip-rows", type=int, default=64,
+                        help="number of rows encrypted at a time, defaults to %(default)s")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the random colors, to make the same images again")
+    args = parser.parse_args(argv)
 
-def make_chunk(size):
-    return tuple(random_color() for _ in xrange(size))
+    infile = Image.open(args.input_filename)
+    start = time.perf_counter()
+    for chunk_size in args.chunk_sizes:
+        print("Doing chunk size {}".format(chunk_size))
+        filename = "{}_{}.png".format(args.input_filename, chunk_size)
+        permute_chunks(infile, chunk_size, seeded_rng(args.seed, chunk_size)).save(filename)
+        print("Done in {:.2f}s".format(time.perf_counter() - start))
 
+    for mode in args.aes_modes:
+        print("Encrypting with AES-{}".format(mode.upper()))
+        filename = "{}_{}.png".format(args.input_filename, mode)
+        encrypt_image(infile, mode, seeded_rng(args.seed, 0, AES_MODES.index(mode)), filename,
+                      args.strip_rows)
+        print("Done in {:.2f}s".format(time.perf_counter() - start))
 
-def permute_chunks(image, chunk_size):
-    code_book, used_values, modified = {}, set(), []
-    for chunk in grouper(chunk_size, image.getdata()):
-        try:
-            modified_chunk = code_book[chunk]
-        except KeyError:
-            modified_chunk = make_chunk(chunk_size)
-            while modified_chunk in used_values:
-                modified_chunk = make_chunk(chunk_size)
-            code_book[chunk] = modified_chunk
-            used_values.add(modified_chunk)
-        modified.extend(modified_chunk)
-    output = Image.new("RGB", image.size)
-    pixels = image.size[0] * image.size[1]
-    output.putdata(modified[:pixels])
-    return output
+    print("Printing noisy image")
+    print("Pixels: {}".format(infile.size[0] * infile.size[1]))
+    random_image(infile.size, seeded_rng(args.seed)).save("{}_random.png".format(args.input_filename))
+    print("Done in {:.2f}s".format(time.perf_counter() - start))
 
 
 if __name__ == "__main__":
-    input_filename = sys.argv[1]
-    infile = Image.open(input_filename)
-
-    time.clock()
-    for chunk_size in map(int, sys.argv[2:]):
-        print "Doing chunk size {}".format(chunk_size)
-        filename = "{}_{}.png".format(input_filename, chunk_size)
-        permute_chunks(infile, chunk_size).save(filename)
-        print "Done in {}".format(time.clock())
-
-    print "Printing noisy image"
-    noisy_image = Image.new("RGB", infile.size)
-    pixels = infile.size[0] * infile.size[1]
-    print "Pixels: {}".format(pixels)
-    noisy_data = [random_color() for _ in xrange(pixels)]
-    noisy_image.putdata(noisy_data)
-    noisy_image.save("{}_random.png".format(input_filename))
-    print "Done in {}".format(time.clock())
+    sys.exit(main())
@@ -4,11 +4,15 @@ from docutils import nodes
 from docutils.parsers.rst import Directive
 from docutils.parsers.rst import directives
 from sphinx.errors import ExtensionError
-from copy import copy, deepcopy
+from copy import copy
 import sphinx
+from sphinx import addnodes
 from sphinx.locale import _, __
 from sphinx.util.docutils import SphinxDirective
 from sphinx.transforms import SphinxTransformer
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
 
 sphinx_version = tuple(int(e) for e in sphinx.__version__.split("."))
 
@@ -108,74 +112,180 @@ class CannedAdmonitionDirective(SphinxDirective):
         return [admonition]
 
 
+def init_custom_admonitions(env):
+    """
+    env.custom_admonitions maps template names to their declaration node.
+    env.custom_admonitions_by_doc maps a docname to the names it declares,
+    so that purging a document does not have to scan every template.
+    env.custom_admonition_uses maps a docname to the names of the templates it
+    instantiates, so that it can be rebuilt when one of them changes.
+    """
+    if not hasattr(env, 'custom_admonitions'):
+        env.custom_admonitions = {}
+    if not hasattr(env, 'custom_admonitions_by_doc'):
+        env.custom_admonitions_by_doc = {}
+    if not hasattr(env, 'custom_admonition_uses'):
+        env.custom_admonition_uses = {}
+
+
+def add_custom_admonition(env, declaration):
+    """register a template declaration, warning about duplicate names"""
+    name = declaration["name"]
+    existing = env.custom_admonitions.get(name, None)
+    if existing is not None:
+        logger.warning(
+            __("duplicate admonition template %s, also declared in %s:%s"),
+            name, existing["docname"], existing["lineno"],
+            location=(declaration["docname"], declaration["lineno"]))
+        return
+
+    env.custom_admonitions[name] = declaration
+    env.custom_admonitions_by_doc.setdefault(declaration["docname"], set()).add(name)
+
+
 def purge_declare_admonitions(app, env, docname):
     # purge the cache for some document
     if not hasattr(env, 'custom_admonitions'):
         return
 
-    env.custom_admonitions = [
-        declaration for declaration in env.custom_admonitions
-        if declaration['docname'] != docname
-    ]
+    for name in env.custom_admonitions_by_doc.pop(docname, ()):
+        env.custom_admonitions.pop(name, None)
+        app.canned_admonition_cache.invalidate(name)
+    env.custom_admonition_uses.pop(docname, None)
 
 
 def env_merge_info(app, env, docnames, other) -> None:
     if not hasattr(other, 'custom_admonitions'):
         return
 
+    init_custom_admonitions(env)
+
+    # other also holds a copy of the templates which were there when it was forked,
+    # only take the ones declared by the documents it actually read
+    for docname in docnames:
+        for name in other.custom_admonitions_by_doc.get(docname, ()):
+            add_custom_admonition(env, other.custom_admonitions[name])
+        if docname in other.custom_admonition_uses:
+            env.custom_admonition_uses[docname] = other.custom_admonition_uses[docname]
+
+
+def get_outdated_template_users(app, env, added, changed, removed):
+    """
+    the documents instantiating a template declared by a document which changed,
+    as their admonitions are only filled in when they are written.
+    templates which are not declared anymore may be declared by an added document.
+    """
     if not hasattr(env, 'custom_admonitions'):
-        env.custom_admonitions = []
+        return []
 
-    env.custom_admonitions.extend(other.custom_admonitions)
+    outdated_names = set()
+    for docname in changed | removed:
+        outdated_names.update(env.custom_admonitions_by_doc.get(docname, ()))
 
-def find_custom_admonition(admonitions, name):
-    for admonition in admonitions:
-        if admonition["name"] == name:
-            return admonition
-    return None
+    outdated_docs = []
+    for docname, names in env.custom_admonition_uses.items():
+        if docname in changed or docname in removed:
+            continue
+        if not names.isdisjoint(outdated_names) or not names <= env.custom_admonitions.keys():
+            outdated_docs.append(docname)
+    return outdated_docs
 
-def process_canned_admonition_nodes(app, doctree, docname):
-    """edit the canned_admonition nodes to copy properties from the declaration"""
-    env = app.builder.env
 
-    def fixup_node(node):
-        # super dirty hack to get converters to run on stored AST nodes
-        try:
-            # set env.docname during applying post-transforms
-            backup = copy(env.temp_data)
-            env.temp_data['docname'] = docname
+class TemplateBodyCache:
+    """
+    post-transformed template bodies, keyed by (template name, builder name, docname).
+    the docname is None unless the template contains nodes whose post-transformed
+    form depends on the document they end up in, such as cross references.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, name, declaration, key):
+        entry = self.entries.get(name, {}).get(key, None)
+        if entry is None:
+            return None
+
+        # the declaring document was re-read since this entry was built
+        cached_declaration, body = entry
+        if cached_declaration is not declaration:
+            return None
+        return body
+
+    def set(self, name, declaration, key, body):
+        self.entries.setdefault(name, {})[key] = (declaration, body)
+
+    def invalidate(self, name):
+        self.entries.pop(name, None)
+
+
+def is_docname_sensitive(declaration):
+    """whether post-transforms output depends on the document the template is used in"""
+    return any(declaration.traverse(addnodes.pending_xref))
+
+
+def transformed_template_body(app, env, declaration, docname):
+    """run post-transforms on a copy of the template, reusing previous results"""
+    name = declaration["name"]
+    if is_docname_sensitive(declaration):
+        key = (app.builder.name, docname)
+    else:
+        key = (app.builder.name, None)
+
+    cache = app.canned_admonition_cache
+    body = cache.get(name, declaration, key)
+    if body is not None:
+        return body
+
+    template_copy = declaration.deepcopy()
+    # super dirty hack to get converters to run on stored AST nodes
+    try:
+        # set env.docname during applying post-transforms
+        backup = copy(env.temp_data)
+        env.temp_data['docname'] = docname
+
+        transformer = SphinxTransformer(template_copy)
+        transformer.set_environment(env)
+        transformer.add_transforms(app.registry.get_post_transforms())
+        transformer.apply_transforms()
+    except ExtensionError:
+        # nothing is cached, the build stops with the error
+        logger.error(__("post-transforms failed on admonition template %s, used in %s"),
+                     name, docname, location=(declaration["docname"], declaration["lineno"]))
+        raise
+    finally:
+        env.temp_data = backup
+
+    body = template_copy.children
+    cache.set(name, declaration, key, body)
+    return body
 
-            transformer = SphinxTransformer(node)
-            transformer.set_environment(env)
-            transformer.add_transforms(app.registry.get_post_transforms())
-            transformer.apply_transforms()
-        except ExtensionError:
-            import pdb; pdb.post_mortem()
-        finally:
-            env.temp_data = backup
 
+def process_canned_admonition_nodes(app, doctree, docname):
+    """edit the canned_admonition nodes to copy properties from the declaration"""
+    env = app.builder.env
 
     for node in doctree.traverse(canned_admonition):
         template_node_name = node["template"]
 
-        template_node = find_custom_admonition(env.custom_admonitions, template_node_name)
+        template_node = env.custom_admonitions.get(template_node_name, None)
         if template_node is None:
-            raise ExtensionError(_("Admonition template %s not found") % template_node)
+            raise ExtensionError(_("Admonition template %s not found") % template_node_name)
 
         node["type"] = template_node["type"]
         node["box_class"] = template_node["box_class"]
         template_title = template_node["title"]
         node_title = node["title"]
 
-        for template_node in reversed(template_node.children):
-            node.insert(0, deepcopy(template_node))
+        # the instance content was already post-transformed along with its document
+        body = transformed_template_body(app, env, template_node, docname)
+        for template_child in reversed(body):
+            node.insert(0, template_child.deepcopy())
 
         title = template_title
         if node_title is not None:
             title = node_title
 
         node["title"] = title
-        fixup_node(node)
 
 
 def register_admonition_declarations(app, doctree):
@@ -185,15 +295,24 @@ def register_admonition_declarations(app, doctree):
     to be suitable for use (ImageCollector sets up images).
     """
     env = app.builder.env
-
-    if not hasattr(env, 'custom_admonitions'):
-        env.custom_admonitions = []
+    init_custom_admonitions(env)
 
     for node in doctree.traverse(declare_admonition):
-        env.custom_admonitions.append(node.deepcopy())
+        add_custom_admonition(env, node.deepcopy())
         node.parent.remove(node)
 
+
+def register_admonition_uses(app, doctree):
+    """record the templates instantiated by the document"""
+    env = app.builder.env
+    init_custom_admonitions(env)
+
+    names = {node["template"] for node in doctree.traverse(canned_admonition)}
+    if names:
+        env.custom_admonition_uses[env.docname] = names
+
 def setup(app):
+    app.canned_admonition_cache = TemplateBodyCache()
     app.add_node(declare_admonition)
     app.add_node(canned_admonition,
                  html=(visit_canned_admonition_node, depart_canned_admonition_node),
@@ -204,12 +323,15 @@ def setup(app):
     app.add_directive('canned_admonition', CannedAdmonitionDirective)
     app.add_directive('declare_admonition', DeclareAdmonitionDirective)
     app.connect('doctree-read', register_admonition_declarations)
+    app.connect('doctree-read', register_admonition_uses)
     app.connect('doctree-resolved', process_canned_admonition_nodes)
     app.connect('env-purge-doc', purge_declare_admonitions)
     app.connect('env-merge-info', env_merge_info)
+    app.connect('env-get-outdated', get_outdated_template_users)
 
     return {
         'version': '0.1',
+        'env_version': 2,
         'parallel_read_safe': True,
         'parallel_write_safe': True,
     }
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+
+"""
+Builds the .svg illustrations used by the book.
+
+Every illustration source below Illustrations/ is converted to pdf, then to svg:
+
+ - X.pbm: potrace
+ - X.dot: neato
+ - create_prp_illustrations.py: run to draw svgs directly, without pdfs. the
+   illustrations it draws are listed in PRP_VARIANTS.
+ - X.mp: mptopdf, with the macros in Illustrations/*.mp
+ - X-illustration.tex: pdflatex, then ghostscript to compress the result, as large
+   pdfs make librsvg crash. these include the pdfs made from the .pbm files of
+   their directory, which are built first.
+
+Sources are scanned for the files they include: `input` statements in MetaPost,
+and \input and \includegraphics in TeX, including image names passed as
+arguments to the macros of included files. An asset is rebuilt when any of these
+change, and TeX illustrations depend on the assets making the pdfs they include.
+
+mptopdf and pdflatex write temporary files to their working directory, so each
+job runs in its own temporary directory, which mirrors the source directory with
+symlinks. Jobs are scheduled over a pool of workers as soon as their dependencies
+are built.
+
+Outdated assets are first looked up in a cache directory, keyed by the content of
+their sources, the files they include and the versions of the tools converting
+them, so that a fresh checkout only converts the illustrations which changed.
+"""
+
+import argparse
+import hashlib
+import os
+import pathlib
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+
+root = pathlib.Path(__file__).resolve().parent
+illustrations_dir = root / "Illustrations"
+default_cache_dir = root.parent / "_build_cache" / "assets"
+
+# bump to invalidate all cached assets when the conversion steps change
+CACHE_VERSION = "2"
+
+# compress pdf assets, which otherwise are big enough to make librsvg crash
+GS_QUALITY = "ebook"
+GS_COMPRESS = ["gs", "-sDEVICE=pdfwrite", "-dCompatibilityLevel=1.4",
+               "-dPDFSETTINGS=/%s" % GS_QUALITY, "-dNOPAUSE", "-dQUIET", "-dBATCH"]
+
+
+# the illustrations of the book drawn by create_prp_illustrations.py
+PRP_VARIANTS = ["AllNodes", "Encryption", "Decryption", "Encryption2"]
+
+
+class AssetError(Exception):
+    pass
+
+
+def run(command, cwd=None):
+    try:
+        subprocess.run(command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                       stderr=subprocess.STDOUT, check=True)
+    except OSError as exc:
+        raise AssetError("cannot run %s: %s" % (command[0], exc)) from exc
+    except subprocess.CalledProcessError as exc:
+        output = exc.stdout.decode(errors="replace")
+        raise AssetError("%s failed:\n%s" % (" ".join(map(str, command)), output)) from exc
+
+
+@lru_cache(maxsize=None)
+def tool_version(*command):
+    """
+    the first line printed by a version command. pdf2svg has none, so the first
+    line of its usage message is used.
+    """
+    try:
+        result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    except OSError:
+        return "missing"
+
+    for line in result.stdout.decode(errors="replace").splitlines():
+        if line.strip():
+            return line.strip()
+    return ""
+
+
+@lru_cache(maxsize=None)
+def file_digest(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+comment_re = re.compile(r"(?<!\\)%.*")
+mp_input_re = re.compile(r"\binput\s+([^;\s]+)")
+tex_input_re = re.compile(r"\\(?:input|include)\s*\{([^}]+)\}")
+tex_graphics_re = re.compile(r"\\includegraphics\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}")
+tex_definition_re = re.compile(
+    r"\\(?:newcommand|renewcommand|NewDocumentCommand)\s*\{?\\(\w+)\}?")
+tex_call_re = re.compile(r"\\(\w+)")
+tex_group_re = re.compile(r"\{([^{}\\]*)\}")
+word_re = re.compile(r"^[\w./-]+$")
+
+
+def read_source(path):
+    return comment_re.sub("", path.read_text(errors="replace"))
+
+
+def scan_metapost(source):
+    """
+    the .mp files read by `input` statements, recursively. mpost resolves these
+    relative to its working directory, which is the directory of the illustration.
+    inputs which aren't found there, such as TEX, come from the TeX distribution.
+    """
+    included = []
+    stack = [source]
+    while stack:
+        for name in mp_input_re.findall(read_source(stack.pop())):
+            path = source.parent / name
+            if path.suffix != ".mp":
+                path = path.with_name(path.name + ".mp")
+            path = pathlib.Path(os.path.normpath(path))
+            if path.is_file() and path not in included:
+                included.append(path)
+                stack.append(path)
+    return sorted(included)
+
+
+def group_words(text):
+    """the comma separated words of the brace groups in text, such as {Base, Alice}"""
+    for group in tex_group_re.findall(text):
+        for word in group.split(","):
+            word = word.strip()
+            if word_re.match(word):
+                yield word
+
+
+def scan_tex(source):
+    """
+    return the files included by a tex illustration, and the names of the
+    graphics it may include. graphics are often included by macros of an \input
+    file, with their name as a parameter: the words passed as arguments by the
+    illustration are matched against the parameters of the macros it uses.
+    """
+    included = []
+    stack = [source]
+    while stack:
+        for name in tex_input_re.findall(read_source(stack.pop())):
+            path = source.parent / name
+            if path.suffix != ".tex":
+                path = path.with_name(path.name + ".tex")
+            if path.is_file() and path not in included:
+                included.append(path)
+                stack.append(path)
+
+    # split included files into macro definitions, and text which is always used
+    top_level = [read_source(source)]
+    macros = {}
+    for path in included:
+        text = read_source(path)
+        definitions = list(tex_definition_re.finditer(text))
+        if not definitions:
+            top_level.append(text)
+            continue
+        top_level.append(text[:definitions[0].start()])
+        for definition, next_definition in zip(definitions, definitions[1:] + [None]):
+            end = len(text) if next_definition is None else next_definition.start()
+            macros[definition.group(1)] = text[definition.end():end]
+
+    # find the macros used by the illustration, directly or through other macros
+    used_texts = list(top_level)
+    used_macros = set()
+    stack = [call for text in top_level for call in tex_call_re.findall(text)]
+    while stack:
+        name = stack.pop()
+        if name in macros and name not in used_macros:
+            used_macros.add(name)
+            used_texts.append(macros[name])
+            stack.extend(tex_call_re.findall(macros[name]))
+
+    arguments = set(word for text in top_level for word in group_words(text))
+    graphics = set()
+    for text in used_texts:
+        graphics.update(group_words(text))
+        for name in tex_graphics_re.findall(text):
+            if "#" not in name:
+                graphics.add(name)
+        # parametrized names such as {#1MixedSecret}
+        for group in tex_group_re.findall(text) + re.findall(r"\{(#[^{}]*)\}", text):
+            if "#" in group:
+                for word in arguments:
+                    graphics.add(re.sub(r"#\d", word, group))
+
+    graphics_paths = set()
+    for name in graphics:
+        path = source.parent / name
+        if not path.suffix:
+            path = path.with_name(path.name + ".pdf")
+        graphics_paths.add(pathlib.Path(os.path.normpath(path)))
+    return sorted(included), graphics_paths
+
+
+def mirror(source_dir, workdir):
+    """
+    symlink the files of source_dir into a directory of workdir at the same
+    depth below Illustrations/, next to links to the top level files, so that
+    relative inputs such as `input ../common;` keep working.
+    """
+    mirror_dir = workdir / source_dir.relative_to(illustrations_dir)
+    mirror_dir.mkdir(parents=True, exist_ok=True)
+    for directory, target_dir in ((illustrations_dir, workdir), (source_dir, mirror_dir)):
+        for entry in directory.iterdir():
+            link = target_dir / entry.name
+            if entry.is_file() and not link.exists():
+                link.symlink_to(entry)
+    return mirror_dir
+
+
+def replace(tmp_path, path):
+    """move a finished output in place, so that no partial file is ever left behind"""
+    shutil.move(str(tmp_path), str(path.with_name(path.name + ".tmp")))
+    os.replace(path.with_name(path.name + ".tmp"), path)
+
+
+class AssetCache:
+    """converted assets, stored as <cache_dir>/<key[:2]>/<key>.pdf and .svg"""
+    def __init__(self, cache_dir):
+        self.cache_dir = pathlib.Path(cache_dir)
+
+    def entry(self, key, suffix):
+        return self.cache_dir / key[:2] / (key + suffix)
+
+    def restore(self, key, asset):
+        """copy a cached conversion in place, returning whether it was found"""
+        pdf_entry = self.entry(key, ".pdf")
+        svg_entry = self.entry(key, ".svg")
+        if not pdf_entry.is_file() or not svg_entry.is_file():
+            return False
+
+        # the pdf goes first, so that the svg ends up newer
+        for entry, path in ((pdf_entry, asset.pdf), (svg_entry, asset.svg)):
+            tmp_path = path.with_name(path.name + ".tmp")
+            shutil.copyfile(entry, tmp_path)
+            os.replace(tmp_path, path)
+        return True
+
+    def store(self, key, asset):
+        for suffix, path in ((".pdf", asset.pdf), (".svg", asset.svg)):
+            entry = self.entry(key, suffix)
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            # concurrent builds may share the cache
+            tmp_entry = entry.with_name("%s.%d.tmp" % (entry.name, os.getpid()))
+            shutil.copyfile(path, tmp_entry)
+            os.replace(tmp_entry, entry)
+
+
+class Asset:
+    """an illustration source, and the svg it is converted to"""
+    # commands printing the version of the tools converting the asset
+    tool_versions = [("pdf2svg",)]
+
+    def __init__(self, source, name):
+        self.source = source
+        self.svg = source.with_name(name + ".svg")
+        self.pdf = source.with_name(name + ".pdf")
+        # assets whose pdf must exist before this one is built
+        self.deps = []
+        # files read during the conversion, besides the source and dependencies
+        self.includes = []
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, self.svg.relative_to(root))
+
+    def inputs(self):
+        return [self.source] + self.includes + [dep.pdf for dep in self.deps]
+
+    def scan(self):
+        """return the files this asset includes, and the graphics it may include"""
+        return [], set()
+
+    @lru_cache(maxsize=None)
+    def cache_key(self):
+        digest = hashlib.sha256()
+        parts = [CACHE_VERSION, type(self).__name__, self.source.name, file_digest(self.source)]
+        for path in self.includes:
+            parts.extend((str(path.relative_to(illustrations_dir)), file_digest(path)))
+        for dep in self.deps:
+            parts.extend((dep.pdf.name, dep.cache_key()))
+        for command in self.tool_versions:
+            parts.append(tool_version(*command))
+        digest.update("\0".join(parts).encode())
+        return digest.hexdigest()
+
+    def make_pdf(self, workdir):
+        raise NotImplementedError
+
+    def pdf_outdated(self):
+        if not self.pdf.exists():
+            return True
+        pdf_mtime = self.pdf.stat().st_mtime
+        return any(path.stat().st_mtime > pdf_mtime for path in self.inputs())
+
+    def svg_outdated(self):
+        return not self.svg.exists() or self.pdf.stat().st_mtime > self.svg.stat().st_mtime
+
+    def build(self, cache=None):
+        """return "built" or "restored" if the svg was updated, None if it was up to date"""
+        pdf_outdated = self.pdf_outdated()
+        if not pdf_outdated and not self.svg_outdated():
+            return None
+
+        if cache is not None and cache.restore(self.cache_key(), self):
+            return "restored"
+
+        with tempfile.TemporaryDirectory(prefix="crypto101-assets-") as tmp:
+            workdir = pathlib.Path(tmp)
+            if pdf_outdated:
+                replace(self.make_pdf(workdir), self.pdf)
+
+            tmp_svg = workdir / self.svg.name
+            run(["pdf2svg", self.pdf, tmp_svg])
+            replace(tmp_svg, self.svg)
+
+        if cache is not None:
+            cache.store(self.cache_key(), self)
+        return "built"
+
+
+class PbmAsset(Asset):
+    tool_versions = [("potrace", "--version"), ("pdf2svg",)]
+
+    def make_pdf(self, workdir):
+        tmp_pdf = workdir / self.pdf.name
+        run(["potrace", "-b", "pdf", "-o", tmp_pdf, self.source])
+        return tmp_pdf
+
+
+class DotAsset(Asset):
+    tool_versions = [("neato", "-V"), ("pdf2svg",)]
+
+    def make_pdf(self, workdir):
+        tmp_pdf = workdir / self.pdf.name
+        run(["neato", "-Tpdf", "-o", tmp_pdf, self.source])
+        return tmp_pdf
+
+
+class PrpAsset(Asset):
+    """an svg drawn by create_prp_illustrations.py, which is fast enough not to be cached"""
+    tool_versions = []
+
+    def __init__(self, source, name):
+        super().__init__(source, name)
+        self.pdf = None
+
+    def inputs(self):
+        return [self.source]
+
+    def build(self, cache=None):
+        if self.svg.exists() and self.svg.stat().st_mtime >= self.source.stat().st_mtime:
+            return None
+
+        with tempfile.TemporaryDirectory(prefix="crypto101-assets-") as tmp:
+            workdir = pathlib.Path(tmp)
+            run([sys.executable, self.source, "-o", workdir, self.svg.stem])
+            replace(workdir / self.svg.name, self.svg)
+        return "built"
+
+
+class MetapostAsset(Asset):
+    tool_versions = [("mpost", "--version"), ("mptopdf", "--version"), ("pdf2svg",)]
+
+    def scan(self):
+        return scan_metapost(self.source), set()
+
+    def make_pdf(self, workdir):
+        mirror_dir = mirror(self.source.parent, workdir)
+        run(["mptopdf", "--metafun", self.source.name], cwd=mirror_dir)
+        return mirror_dir / (self.source.stem + "-mps.pdf")
+
+
+class TexAsset(Asset):
+    tool_versions = [("pdflatex", "--version"), ("gs", "--version"), ("pdf2svg",)]
+
+    def scan(self):
+        return scan_tex(self.source)
+
+    def make_pdf(self, workdir):
+        mirror_dir = mirror(self.source.parent, workdir)
+        run(["pdflatex", "-interaction=nonstopmode", "-halt-on-error", self.source.name],
+            cwd=mirror_dir)
+        tmp_pdf = workdir / self.pdf.name
+        run(GS_COMPRESS + ["-sOutputFile=%s" % tmp_pdf, self.source.stem + ".pdf"],
+            cwd=mirror_dir)
+        return tmp_pdf
+
+
+def find_assets():
+    assets = []
+    for source in sorted(illustrations_dir.glob("*/*")):
+        if source.suffix == ".pbm":
+            assets.append(PbmAsset(source, source.stem))
+        elif source.suffix == ".dot":
+            assets.append(DotAsset(source, source.stem))
+        elif source.name == "create_prp_illustrations.py":
+            assets.extend(PrpAsset(source, name) for name in PRP_VARIANTS)
+        elif source.suffix == ".mp":
+            assets.append(MetapostAsset(source, source.stem))
+        elif source.name.endswith("-illustration.tex"):
+            assets.append(TexAsset(source, source.name[:-len("-illustration.tex")]))
+
+    by_pdf = {asset.pdf: asset for asset in assets if asset.pdf is not None}
+    for asset in assets:
+        includes, graphics = asset.scan()
+        asset.deps = [by_pdf[path] for path in sorted(graphics) if path in by_pdf]
+        asset.includes = includes + sorted(path for path in graphics
+                                           if path not in by_pdf and path.is_file())
+    return assets
+
+
+def select_assets(assets, targets):
+    """the assets building the given svg paths, along with their dependencies"""
+    by_svg = {asset.svg: asset for asset in assets}
+    selected = []
+
+    def add(asset):
+        if asset in selected:
+            return
+        for dep in asset.deps:
+            add(dep)
+        selected.append(asset)
+
+    for target in targets:
+        asset = by_svg.get(pathlib.Path(target).resolve(), None)
+        if asset is None:
+            raise AssetError("no rule to build %s" % target)
+        add(asset)
+    return selected
+
+
+def build_assets(assets, jobs=None, cache=None, log=print):
+    """build assets in dependency order, return the list of failed assets"""
+    jobs = jobs or os.cpu_count() or 1
+    pending = list(assets)
+    done = set()
+    failed = []
+    running = {}
+    counts = {"built": 0, "restored": 0}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for asset in list(pending):
+                if any(dep in failed for dep in asset.deps):
+                    pending.remove(asset)
+                    failed.append(asset)
+                    log("skipping %s: a dependency failed" % asset.svg.relative_to(root))
+                elif all(dep in done or dep not in assets for dep in asset.deps):
+                    pending.remove(asset)
+                    running[executor.submit(asset.build, cache)] = asset
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                asset = running.pop(future)
+                try:
+                    status = future.result()
+                    if status is not None:
+                        counts[status] += 1
+                        log("%s %s" % (status, asset.svg.relative_to(root)))
+                    done.add(asset)
+                except AssetError as exc:
+                    log("error building %s: %s" % (asset.svg.relative_to(root), exc))
+                    failed.append(asset)
+
+    if counts["built"] or counts["restored"]:
+        log("assets: %d built, %d restored from the cache" % (counts["built"], counts["restored"]))
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of parallel jobs, defaults to the number of cpus")
+    parser.add_argument("--cache-dir", default=str(default_cache_dir),
+                        help="where converted assets are cached, defaults to %(default)s")
+    parser.add_argument("--no-cache", action="store_true", help="don't use the asset cache")
+    parser.add_argument("targets", nargs="*", help="svg files to build, defaults to all")
+    args = parser.parse_args(argv)
+
+    assets = find_assets()
+    try:
+        if args.targets:
+            assets = select_assets(assets, args.targets)
+    except AssetError as exc:
+        print(exc, file=sys.stderr)
+        return 2
+
+    cache = None
+    if not args.no_cache:
+        cache = AssetCache(args.cache_dir)
+
+    failed = build_assets(assets, args.jobs, cache)
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
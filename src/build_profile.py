@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+"""
+Measures the time spent in the event handlers and node visitors of extensions.
+
+When build_profile is set, the handlers connected by the extensions listed in
+build_profile_modules (by default, all the extensions of the configuration), the
+node visitors and math renderers they register, and the methods of the domains
+and transforms they add are wrapped to record their call count, cumulative and
+maximum time, in total and for every document.
+
+At build-finished, build-profile.json is written to the doctree directory, along
+with build-profile.folded, which holds the time spent in every handler as the
+folded stacks read by flamegraph.pl and speedscope: event or visitor, handler,
+then document, in microseconds.
+
+Handlers running in the worker processes of parallel builds (-j) aren't
+measured, as these don't report back to the main process.
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from os import path
+
+from sphinx.events import EventListener
+from sphinx.locale import __
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+# events emitted before the handlers are wrapped
+SKIPPED_EVENTS = {"config-inited"}
+DOMAIN_METHODS = ["process_doc", "clear_doc", "merge_domaindata", "resolve_xref",
+                  "resolve_any_xref", "check_consistency"]
+TRANSFORM_METHODS = ["apply", "run"]
+
+
+class Timing:
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def to_json(self):
+        return {"calls": self.calls, "total": self.total, "max": self.max}
+
+
+class HandlerProfile:
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.timing = Timing()
+        self.documents = defaultdict(Timing)
+
+    def to_json(self):
+        result = {"kind": self.kind, "handler": self.name}
+        result.update(self.timing.to_json())
+        result["documents"] = {docname: timing.to_json()
+                               for docname, timing in sorted(self.documents.items())}
+        return result
+
+
+class BuildProfile:
+    """
+    the timings of every wrapped handler. handlers may run inside one another,
+    such as visitors calling render functions: the folded stacks only count the
+    time spent in a handler itself.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.handlers = {}
+        self.folded = defaultdict(float)
+        self.local = threading.local()
+
+    def current_docname(self):
+        env = self.app.env
+        if env is not None and env.temp_data.get("docname"):
+            return env.temp_data["docname"]
+        return getattr(self.app.builder, "current_docname", None)
+
+    def wrap(self, kind, func):
+        name = "%s.%s" % (func.__module__, getattr(func, "__qualname__", repr(func)))
+        profile = self.handlers.get((kind, name))
+        if profile is None:
+            profile = self.handlers[(kind, name)] = HandlerProfile(kind, name)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = getattr(self.local, "stack", None)
+            if stack is None:
+                stack = self.local.stack = []
+            frame = [kind, name, 0.0]
+            stack.append(frame)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stack.pop()
+                if stack:
+                    # the caller only keeps its own time
+                    stack[-1][2] += elapsed
+                self.record(profile, stack, frame, elapsed)
+
+        wrapper.__wrapped_by_build_profile__ = True
+        return wrapper
+
+    def record(self, profile, stack, frame, elapsed):
+        docname = self.current_docname()
+        profile.timing.add(elapsed)
+        if docname is not None:
+            profile.documents[docname].add(elapsed)
+
+        frames = []
+        for kind, name, _children in stack + [frame]:
+            frames.extend((kind, name))
+        if docname is not None:
+            frames.append(docname)
+        self.folded[";".join(frames)] += elapsed - frame[2]
+
+    def to_json(self):
+        handlers = sorted(self.handlers.values(), key=lambda handler: -handler.timing.total)
+        return {
+            "builder": self.app.builder.name,
+            "handlers": [handler.to_json() for handler in handlers if handler.timing.calls],
+        }
+
+    def write(self, outdir):
+        json_path = path.join(outdir, "build-profile.json")
+        with open(json_path, "w") as fp:
+            json.dump(self.to_json(), fp, indent=2)
+
+        folded_path = path.join(outdir, "build-profile.folded")
+        with open(folded_path, "w") as fp:
+            for stack, seconds in sorted(self.folded.items()):
+                microseconds = round(seconds * 1e6)
+                if microseconds:
+                    # frames are separated by semicolons
+                    fp.write("%s %d\n" % (stack.replace(" ", "_"), microseconds))
+        return json_path, folded_path
+
+
+def is_profiled(func, modules):
+    if func is None or getattr(func, "__wrapped_by_build_profile__", False):
+        return False
+    module = getattr(func, "__module__", None) or ""
+    return any(module == name or module.startswith(name + ".") for name in modules)
+
+
+def wrap_pair(profile, kind, pair, modules):
+    visit, depart = pair
+    if is_profiled(visit, modules):
+        visit = profile.wrap("visit:" + kind, visit)
+    if depart is not None and is_profiled(depart, modules):
+        depart = profile.wrap("depart:" + kind, depart)
+    return visit, depart
+
+
+def profiled_subclass(profile, kind, cls, methods, modules):
+    """a subclass of cls measuring the given methods, if any of them belongs to modules"""
+    wrapped = {}
+    for method in methods:
+        func = getattr(cls, method, None)
+        if is_profiled(func, modules):
+            wrapped[method] = profile.wrap(kind, func)
+    if not wrapped:
+        return cls
+
+    wrapped["__module__"] = cls.__module__
+    wrapped["__qualname__"] = cls.__qualname__
+    return type(cls.__name__, (cls,), wrapped)
+
+
+def install_profile(app, config):
+    if not config.build_profile:
+        return
+
+    modules = config.build_profile_modules
+    if modules is None:
+        modules = [name for name in config.extensions if name != __name__]
+
+    profile = app.build_profile = BuildProfile(app)
+    for event, listeners in app.events.listeners.items():
+        if event in SKIPPED_EVENTS:
+            continue
+        for i, listener in enumerate(listeners):
+            if is_profiled(listener.handler, modules):
+                # keep the ids, which disconnect() relies on
+                handler = profile.wrap("event:" + event, listener.handler)
+                listeners[i] = EventListener(listener.id, handler, listener.priority)
+
+    registry = app.registry
+    for builder_name, handlers in registry.translation_handlers.items():
+        for node_name, pair in handlers.items():
+            kind = "%s:%s" % (builder_name, node_name)
+            handlers[node_name] = wrap_pair(profile, kind, pair, modules)
+
+    for renderers, node_name in ((registry.html_inline_math_renderers, "math"),
+                                 (registry.html_block_math_renderers, "math_block")):
+        for renderer_name, pair in renderers.items():
+            kind = "html:%s:%s" % (node_name, renderer_name)
+            renderers[renderer_name] = wrap_pair(profile, kind, pair, modules)
+
+    for domain_name, domain in registry.domains.items():
+        registry.domains[domain_name] = profiled_subclass(
+            profile, "domain:" + domain_name, domain, DOMAIN_METHODS, modules)
+
+    for kind, transforms in (("transform", registry.transforms),
+                             ("post-transform", registry.post_transforms)):
+        transforms[:] = [profiled_subclass(profile, kind, transform, TRANSFORM_METHODS, modules)
+                         for transform in transforms]
+
+
+def write_profile(app, exc):
+    profile = getattr(app, "build_profile", None)
+    if profile is None or exc is not None:
+        return
+
+    json_path, folded_path = profile.write(app.doctreedir)
+    logger.info(__("build profile written to %s and %s"), json_path, folded_path)
+
+
+def setup(app):
+    # measure the handlers of extensions, which slows the build down a little
+    app.add_config_value("build_profile", False, "")
+    # the modules whose handlers are measured, defaults to all extensions
+    app.add_config_value("build_profile_modules", None, "")
+
+    # after the other extensions connected their handlers
+    app.connect("config-inited", install_profile, priority=900)
+    app.connect("build-finished", write_profile)
+
+    return {
+        'version': '0.1',
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
@@ -3,7 +3,6 @@
 
 import sys
 import pathlib
-from string import Template
 from sphinx.locale import _
 
 try:
@@ -26,10 +25,20 @@ extensions = [
     "sphinxcontrib.bibtex",
     "sphinxcontrib.rsvgconverter",
     "sphinx.ext.imgmath",
+    "imgmath_cache",
+    "imgmath_batch",
+    "latex_templates",
+    "i18n_incremental",
     "admonition_templates",
     "subfig",
+    "search_shards",
+    "build_profile",
 ]
 
+# time the handlers of the extensions, writing build-profile.json and
+# build-profile.folded to the doctree directory. also enabled by -D build_profile=1
+build_profile = False
+
 # number figures
 numfig = True
 numfig_secnum_depth = 2
@@ -52,19 +61,16 @@ copyright = "2020, Laurens Van Houtven (lvh)"
 author = "lvh"
 
 # these can be accessed as |version| and |release| inside the .rst source
-import subprocess
-
-
-def run_command(*args):
-    return subprocess.check_output(args).decode().strip()
+from gitversion import get_version
 
-
-version = run_command("git", "rev-parse", "--short", "HEAD")
-release = run_command("git", "describe", "--always")
+version, release = get_version()
 
 # i18n configuration
 locale_dirs = ["locale/"]
 gettext_compact = False
+# only write the .pot and compile the .mo files of the catalogs which changed,
+# so that translated builds only read the documents whose translations changed
+i18n_incremental = True
 
 
 pygments_style = "sphinx"
@@ -85,25 +91,20 @@ html_theme_options = {
 
 html_show_sourcelink = False
 html_static_path = ["_static"]
+# the search page only loads the parts of the search index its query needs
+search_shards = True
 htmlhelp_basename = "crypto101"
 
 epub_basename = "crypto101"
 epub_css_files = ["epub_style.css"]
 
-def read_latex_source(name: str) -> str:
-    name += ".tex"
-    with (root / "latex" / name).open("r") as fp:
-        return fp.read()
-
-
-def read_latex_template(name: str) -> str:
-    return Template(read_latex_source(name)).substitute(globals())
-
-
-# inline math is rendered as svg, and needs a preamble to render properly
-imgmath_latex_preamble = read_latex_source("imgmath")
+# inline math is rendered as svg, and needs a preamble to render properly.
+# latex/imgmath.tex is only read by the html builders
+imgmath_latex_preamble_template = "imgmath"
 imgmath_image_format = "svg"
 imgmath_font_size = 16
+# rendered formulas are shared by all languages and build directories
+imgmath_cache_dir = "../_build_cache/imgmath"
 
 # whether to show the page number after references
 latex_show_pagerefs = True
@@ -159,9 +160,14 @@ latex_elements = {
     "passoptionstopackages": """
 \PassOptionsToPackage{dvipsnames,table}{xcolor}
     """,
-    "preamble": read_latex_template("preamble"),
-    "hyperref": read_latex_template("hyperref"),
-    "maketitle": read_latex_template("maketitle"),
+}
+
+# latex_elements read from latex/ by the latex builder only, substituting
+# $project, $author and other configuration values
+latex_templates = {
+    "preamble": "preamble",
+    "hyperref": "hyperref",
+    "maketitle": "maketitle",
 }
 
 latex_additional_files = ["./Illustrations/CC/CC-BY-NC.pdf"]
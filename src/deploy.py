@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+Deploys the html book, only uploading the files which changed.
+
+The files of BUILDDIR/html are staged in BUILDDIR/deploy, along with .gz and .br
+precompressed copies of the text files, for servers serving these directly, such
+as nginx with gzip_static and brotli_static. Files are only copied and compressed
+again when their content changed since they were staged.
+
+BUILDDIR/deploy.json is the manifest of the last deployment: the target, and the
+sha256 of every staged file. Only the files whose digest changed since are
+uploaded, to a local directory or to an rsync destination such as
+host:/srv/www/. Deploying to another target uploads everything. Files removed
+from the build are left on the target, as rsync -r used to.
+
+.br files need the brotli package, and are skipped without it.
+
+Usage: deploy.py [-j JOBS] BUILDDIR TARGET
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# text files served precompressed, including the search index
+COMPRESSED_SUFFIXES = {".html", ".css", ".js", ".svg", ".txt", ".json", ".xml"}
+
+
+class DeployError(Exception):
+    pass
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with path.open("rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_files(html_dir):
+    """the files of the build, without hidden ones such as .buildinfo"""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(html_dir):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith("."))
+        for filename in sorted(filenames):
+            if not filename.startswith("."):
+                path = pathlib.Path(dirpath) / filename
+                files.append(path.relative_to(html_dir).as_posix())
+    return files
+
+
+def write_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def compressed_variants(name):
+    variants = [(name + ".gz", lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        variants.append((name + ".br", lambda data: brotli.compress(data, quality=11)))
+    return variants
+
+
+def stage_file(html_dir, stage_dir, name, staged):
+    """
+    copy a file of the build to the staging directory, along with its compressed
+    variants, unless its content was already staged. return the digests of the
+    staged files.
+    """
+    source = html_dir / name
+    digest = file_digest(source)
+    names = [name]
+    if source.suffix in COMPRESSED_SUFFIXES:
+        names.extend(variant for variant, _compress in compressed_variants(name))
+
+    up_to_date = staged.get(name) == digest and all(
+        staged_name in staged and (stage_dir / staged_name).is_file() for staged_name in names)
+    if up_to_date:
+        return {staged_name: staged[staged_name] for staged_name in names}
+
+    data = source.read_bytes()
+    write_atomic(stage_dir / name, data)
+    digests = {name: digest}
+    if source.suffix in COMPRESSED_SUFFIXES:
+        for variant, compress in compressed_variants(name):
+            compressed = compress(data)
+            write_atomic(stage_dir / variant, compressed)
+            digests[variant] = hashlib.sha256(compressed).hexdigest()
+    return digests
+
+
+def read_manifest(path):
+    try:
+        with path.open() as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {"target": None, "files": {}}
+
+
+def write_manifest(path, target, files):
+    data = json.dumps({"target": target, "files": files}, indent=1, sort_keys=True)
+    write_atomic(path, data.encode())
+
+
+def is_remote(target):
+    # rsync destinations look like [user@]host:path
+    return ":" in target.split("/", 1)[0]
+
+
+def upload_local(stage_dir, target, names):
+    target_dir = pathlib.Path(target)
+    for name in names:
+        destination = target_dir / name
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        tmp_destination = destination.with_name(destination.name + ".tmp")
+        shutil.copyfile(stage_dir / name, tmp_destination)
+        os.replace(tmp_destination, destination)
+
+
+def upload_rsync(stage_dir, target, names):
+    file_list = "".join(name + "\n" for name in names).encode()
+    command = ["rsync", "--files-from=-", "%s/" % stage_dir, target]
+    try:
+        subprocess.run(command, input=file_list, check=True)
+    except (OSError, subprocess.CalledProcessError) as exc:
+        raise DeployError("%s failed: %s" % (" ".join(command), exc)) from exc
+
+
+def deploy(builddir, target, jobs=None, log=print):
+    """stage and upload the build, returning the number of uploaded files"""
+    html_dir = builddir / "html"
+    stage_dir = builddir / "deploy"
+    manifest_path = builddir / "deploy.json"
+    if not html_dir.is_dir():
+        raise DeployError("%s doesn't exist, build the html first" % html_dir)
+
+    previous = read_manifest(manifest_path)
+    staged = previous["files"]
+    names = source_files(html_dir)
+    files = {}
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        for digests in executor.map(
+                lambda name: stage_file(html_dir, stage_dir, name, staged), names):
+            files.update(digests)
+
+    if previous["target"] == target:
+        changed = sorted(name for name, digest in files.items() if staged.get(name) != digest)
+    else:
+        changed = sorted(files)
+
+    if changed:
+        if is_remote(target):
+            upload_rsync(stage_dir, target, changed)
+        else:
+            upload_local(stage_dir, target, changed)
+    write_manifest(manifest_path, target, files)
+
+    left = sum(1 for name in staged if name not in files)
+    log("deployed %d of %d files to %s%s" % (
+        len(changed), len(files), target,
+        ", %d removed files left on the target" % left if left else ""))
+    return len(changed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of files compressed at the same time, defaults to the cpu count")
+    parser.add_argument("builddir", metavar="BUILDDIR", type=pathlib.Path)
+    parser.add_argument("target", metavar="TARGET",
+                        help="a local directory, or an rsync destination such as host:/srv/www/")
+    args = parser.parse_args(argv)
+
+    if brotli is None:
+        print("brotli isn't installed, no .br files are made", file=sys.stderr)
+
+    try:
+        deploy(args.builddir, args.target, args.jobs)
+    except DeployError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
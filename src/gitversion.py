@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+Finds the |version| and |release| of the book without running git.
+
+conf.py is loaded by every sphinx-build process, including parallel workers and
+every language of a release, so reading a few files beats forking git each time:
+
+ - if the stamp file matches the checked out commit and its annotated tags, its
+   values are used. build_release writes it once per release with
+   `gitversion.py --stamp`, so the output of `git describe` is kept exactly.
+ - otherwise, HEAD and the refs are read from the .git directory. the version is
+   the abbreviated commit hash, and the release is the name of an annotated tag
+   pointing to HEAD: git describe ignores lightweight tags. for other commits,
+   `git describe --always` names the closest tag, and is run once: its output is
+   saved as the stamp for the next loads. the release is the abbreviated hash
+   when git can't be run.
+ - outside of a git checkout, both are "unknown".
+"""
+
+import hashlib
+import os
+import pathlib
+import subprocess
+import sys
+import zlib
+from functools import lru_cache
+
+ABBREV_LEN = 7
+UNKNOWN = "unknown"
+
+project_root = pathlib.Path(__file__).resolve().parent.parent
+stamp_path = project_root / "_build_cache" / "version"
+
+
+def find_git_dir(path):
+    """return the (git dir, common dir) of the checkout containing path"""
+    for directory in (path, *path.parents):
+        dot_git = directory / ".git"
+        if dot_git.is_dir():
+            return dot_git, dot_git
+
+        if dot_git.is_file():
+            # worktrees and submodules use a "gitdir: <path>" file
+            content = dot_git.read_text().strip()
+            if not content.startswith("gitdir:"):
+                return None
+            git_dir = (directory / content[len("gitdir:"):].strip()).resolve()
+            common_dir = git_dir
+            commondir_file = git_dir / "commondir"
+            if commondir_file.is_file():
+                common_dir = (git_dir / commondir_file.read_text().strip()).resolve()
+            return git_dir, common_dir
+    return None
+
+
+def read_packed_refs(common_dir):
+    """return a dict of ref name to (sha, peeled sha or None)"""
+    refs = {}
+    try:
+        lines = (common_dir / "packed-refs").read_text().splitlines()
+    except OSError:
+        return refs
+
+    last_ref = None
+    for line in lines:
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("^"):
+            # the commit an annotated tag points to
+            if last_ref is not None:
+                refs[last_ref] = (refs[last_ref][0], line[1:])
+            continue
+        sha, _, name = line.partition(" ")
+        refs[name] = (sha, None)
+        last_ref = name
+    return refs
+
+
+def resolve_ref(git_dir, common_dir, ref, packed_refs):
+    # HEAD and other per-worktree refs live in the git dir, others in the common dir
+    for base in (git_dir, common_dir):
+        try:
+            content = (base / ref).read_text().strip()
+        except OSError:
+            continue
+        if content.startswith("ref:"):
+            return resolve_ref(git_dir, common_dir, content[len("ref:"):].strip(), packed_refs)
+        return content
+
+    packed = packed_refs.get(ref, None)
+    if packed is not None:
+        return packed[0]
+    return None
+
+
+def read_tag_object(common_dir, sha):
+    """return the commit a loose annotated tag object points to"""
+    try:
+        data = (common_dir / "objects" / sha[:2] / sha[2:]).read_bytes()
+        data = zlib.decompress(data)
+    except (OSError, zlib.error):
+        return None
+
+    header, _, body = data.partition(b"\0")
+    if not header.startswith(b"tag "):
+        return None
+    for line in body.split(b"\n"):
+        if line.startswith(b"object "):
+            return line[len(b"object "):].decode()
+    return None
+
+
+def read_tags(common_dir, packed_refs):
+    """
+    map the names of the annotated tags to the commit they point to. lightweight
+    tags are left out, as git describe ignores them
+    """
+    tags = {}
+    for name, (_sha, peeled) in packed_refs.items():
+        # only annotated tags have a peeled line
+        if name.startswith("refs/tags/") and peeled is not None:
+            tags[name[len("refs/tags/"):]] = peeled
+
+    tags_dir = common_dir / "refs" / "tags"
+    if tags_dir.is_dir():
+        for tag_file in tags_dir.rglob("*"):
+            if tag_file.is_file():
+                commit = read_tag_object(common_dir, tag_file.read_text().strip())
+                if commit is not None:
+                    tags[tag_file.relative_to(tags_dir).as_posix()] = commit
+    return tags
+
+
+def tags_digest(tags):
+    """identifies the tags a stamp was made with, which git describe depends on"""
+    data = "".join("%s %s\n" % item for item in sorted(tags.items()))
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def find_exact_tag(tags, head):
+    matching = sorted(name for name, commit in tags.items() if commit == head)
+    if matching:
+        return matching[0]
+    return None
+
+
+def run_git(*args):
+    return subprocess.check_output(("git", *args), cwd=project_root,
+                                   stderr=subprocess.DEVNULL).decode().strip()
+
+
+def read_stamp(head, tags_key):
+    try:
+        commit, version, release, stamp_tags_key = stamp_path.read_text().splitlines()[:4]
+    except (OSError, ValueError):
+        return None
+    if commit != head or stamp_tags_key != tags_key:
+        return None
+    return version, release
+
+
+def save_stamp(head, version, release, tags_key):
+    stamp_path.parent.mkdir(parents=True, exist_ok=True)
+    # concurrent builds may write it at the same time
+    tmp_path = stamp_path.with_name("%s.%d.tmp" % (stamp_path.name, os.getpid()))
+    tmp_path.write_text("%s\n%s\n%s\n%s\n" % (head, version, release, tags_key))
+    os.replace(tmp_path, stamp_path)
+
+
+def read_repository(path):
+    """return the (HEAD commit, annotated tags) of the checkout containing path"""
+    dirs = find_git_dir(pathlib.Path(path).resolve())
+    if dirs is None:
+        return None
+
+    git_dir, common_dir = dirs
+    packed_refs = read_packed_refs(common_dir)
+    head = resolve_ref(git_dir, common_dir, "HEAD", packed_refs)
+    if head is None:
+        return None
+    return head, read_tags(common_dir, packed_refs)
+
+
+@lru_cache(maxsize=None)
+def get_version(path=project_root):
+    """return the (version, release) pair of the checkout containing path"""
+    repository = read_repository(path)
+    if repository is None:
+        return UNKNOWN, UNKNOWN
+
+    head, tags = repository
+    tags_key = tags_digest(tags)
+    stamped = read_stamp(head, tags_key)
+    if stamped is not None:
+        return stamped
+
+    version = head[:ABBREV_LEN]
+    release = find_exact_tag(tags, head)
+    if release is None:
+        # names the closest tag, which reading the refs can't find
+        try:
+            release = run_git("describe", "--always")
+        except (OSError, subprocess.CalledProcessError):
+            return version, version
+        try:
+            save_stamp(head, version, release, tags_key)
+        except OSError:
+            pass
+    return version, release
+
+
+def write_stamp():
+    """record the output of git itself, for all builds of this commit to use"""
+    repository = read_repository(project_root)
+    tags_key = tags_digest(repository[1]) if repository is not None else ""
+    save_stamp(run_git("rev-parse", "HEAD"), run_git("rev-parse", "--short", "HEAD"),
+               run_git("describe", "--always"), tags_key)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--stamp"]:
+        write_stamp()
+    else:
+        print("%s %s" % get_version())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Keeps translation builds incremental when i18n_incremental is set.
+
+With gettext_compact = False, every document has its own catalog, which only
+changes when the document does. The gettext builder rewrites the .pot of the
+documents which were read again, or whose .pot is missing, rather than all of
+them: -a still writes every catalog.
+
+Sphinx makes every document depend on the .mo of its catalog, and compiles the
+.po files which are newer than their .mo. As tx pull rewrites all the .po files,
+any change would otherwise compile every catalog, and read every document again.
+Outdated .po files are compiled here first: when their messages are the same as
+the ones of the .mo, the .mo is kept and the .po gets the modification time of
+the .mo back, so that only the documents whose translations changed are read.
+"""
+
+import os
+from os import path
+
+from babel.messages.mofile import read_mo, write_mo
+from babel.messages.pofile import read_po
+from sphinx.builders.gettext import MessageCatalogBuilder
+from sphinx.locale import __
+from sphinx.util import logging
+from sphinx.util.i18n import CatalogRepository, docname_to_domain
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalMessageCatalogBuilder(MessageCatalogBuilder):
+    def get_outdated_docs(self):
+        if not self.config.i18n_incremental:
+            return super().get_outdated_docs()
+
+        # the documents which were read again are written anyway
+        return [docname for docname in self.env.found_docs
+                if not path.exists(self.catalog_path(docname))]
+
+    def catalog_path(self, docname):
+        domain = docname_to_domain(docname, self.config.gettext_compact)
+        return path.join(self.outdir, domain + ".pot")
+
+
+def normalized(string):
+    # plural forms are lists in .po files, and tuples in .mo files
+    if isinstance(string, (list, tuple)):
+        return tuple(string)
+    return string
+
+
+def po_messages(catalog):
+    """the messages write_mo keeps: translated and not fuzzy, without the header"""
+    return {(message.id, message.context): normalized(message.string)
+            for message in catalog
+            if message.id and message.string and not message.fuzzy}
+
+
+def mo_messages(catalog):
+    return {(message.id, message.context): normalized(message.string)
+            for message in catalog if message.id}
+
+
+def compile_catalog(catalog, language):
+    """compile an outdated catalog, returning whether its messages changed"""
+    with open(catalog.po_path, encoding=catalog.charset) as fp:
+        po = read_po(fp, language)
+
+    try:
+        with open(catalog.mo_path, "rb") as fp:
+            unchanged = mo_messages(read_mo(fp)) == po_messages(po)
+    except (OSError, ValueError):
+        unchanged = False
+
+    if not unchanged:
+        with open(catalog.mo_path, "wb") as fp:
+            write_mo(fp, po)
+        return True
+
+    po_stat = os.stat(catalog.po_path)
+    mo_stat = os.stat(catalog.mo_path)
+    os.utime(catalog.po_path, ns=(po_stat.st_atime_ns, mo_stat.st_mtime_ns))
+    return False
+
+
+def compile_catalogs(app):
+    config = app.config
+    if not config.i18n_incremental or not config.language or not config.gettext_auto_build:
+        return
+
+    repo = CatalogRepository(app.srcdir, config.locale_dirs, config.language,
+                             config.source_encoding)
+    compiled = unchanged = 0
+    for catalog in repo.catalogs:
+        if not catalog.is_outdated():
+            continue
+        try:
+            changed = compile_catalog(catalog, config.language)
+        except Exception:
+            # left for the builder, which reports the error
+            continue
+
+        if changed:
+            compiled += 1
+        else:
+            unchanged += 1
+
+    if compiled or unchanged:
+        logger.info(__("message catalogs: %d compiled, %d unchanged"), compiled, unchanged)
+
+
+def setup(app):
+    app.add_builder(IncrementalMessageCatalogBuilder, override=True)
+
+    # only write the .pot and compile the .mo files of the catalogs which changed
+    app.add_config_value("i18n_incremental", False, "")
+
+    # before the builder compiles the outdated catalogs
+    app.connect("builder-inited", compile_catalogs)
+
+    return {
+        'version': '0.1',
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
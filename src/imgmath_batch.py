@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+Renders imgmath formulas in batches, before the documents are written.
+
+sphinx.ext.imgmath runs latex and dvisvgm once per formula, from inside the HTML
+translator. This extension collects the formulas of each document as it is read,
+and once the environment is up to date, renders all the ones which are neither in
+the build directory nor in the imgmath_cache: formulas sharing the same LaTeX
+header are laid out one per page in a single document, and batches are compiled
+concurrently. imgmath then finds the images already in place when writing.
+
+Formulas which can't be rendered in a batch are left for imgmath to render one by
+one, so that errors are reported against the right document.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from docutils import nodes
+import sphinx.ext.imgmath as imgmath
+from sphinx.locale import __
+from sphinx.util import logging
+from sphinx.util.math import wrap_displaymath
+from sphinx.util.osutil import ensuredir
+
+from imgmath_cache import cache_key, output_path, tool_version
+
+logger = logging.getLogger(__name__)
+
+BEGIN_DOCUMENT = "\\begin{document}\n"
+END_DOCUMENT = "\n\\end{document}"
+page_re = re.compile(r"math-(\d+)\.svg$")
+
+
+def collect_formulas(app, doctree):
+    """record the math sources the HTML translator will pass to imgmath.render_math"""
+    env = app.builder.env
+    if not hasattr(env, 'imgmath_formulas'):
+        env.imgmath_formulas = {}
+
+    formulas = set()
+    for node in doctree.traverse(nodes.math):
+        formulas.add('$' + node.astext() + '$')
+    for node in doctree.traverse(nodes.math_block):
+        if node['nowrap']:
+            formulas.add(node.astext())
+        else:
+            formulas.add(wrap_displaymath(node.astext(), None, False))
+
+    if formulas:
+        env.imgmath_formulas[env.docname] = formulas
+
+
+def env_purge_doc(app, env, docname):
+    if not hasattr(env, 'imgmath_formulas'):
+        return
+
+    env.imgmath_formulas.pop(docname, None)
+
+
+def env_merge_info(app, env, docnames, other) -> None:
+    if not hasattr(other, 'imgmath_formulas'):
+        return
+
+    if not hasattr(env, 'imgmath_formulas'):
+        env.imgmath_formulas = {}
+
+    for docname in docnames:
+        if docname in other.imgmath_formulas:
+            env.imgmath_formulas[docname] = other.imgmath_formulas[docname]
+
+
+def split_latex(latex):
+    """split a generated imgmath document into its header and body"""
+    header, sep, rest = latex.partition(BEGIN_DOCUMENT)
+    body, sep2, _trailer = rest.rpartition(END_DOCUMENT)
+    if not sep or not sep2:
+        return None
+    return header, body
+
+
+def render_batch(config, header, batch):
+    """
+    render a list of (body, outfn) pairs sharing the same header, one per page.
+    return the list of rendered outfn, which is empty if anything went wrong.
+    """
+    tempdir = tempfile.mkdtemp()
+    try:
+        pages = "\n\\clearpage\n".join(body for body, _outfn in batch)
+        with open(path.join(tempdir, "math.tex"), "w", encoding="utf-8") as fp:
+            fp.write(header + BEGIN_DOCUMENT + pages + END_DOCUMENT + "\n")
+
+        latex_command = [config.imgmath_latex, "--interaction=nonstopmode"]
+        latex_command.extend(config.imgmath_latex_args)
+        latex_command.append("math.tex")
+
+        dvisvgm_command = [config.imgmath_dvisvgm, "-o", path.join(tempdir, "math-%p.svg"),
+                           "--page=1-"]
+        dvisvgm_command.extend(config.imgmath_dvisvgm_args)
+        dvisvgm_command.append(path.join(tempdir, "math.dvi"))
+
+        try:
+            subprocess.run(latex_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           cwd=tempdir, check=True)
+            subprocess.run(dvisvgm_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           check=True)
+        except (OSError, subprocess.CalledProcessError):
+            return []
+
+        # dvisvgm zero-pads page numbers depending on the page count
+        page_files = {}
+        for filename in os.listdir(tempdir):
+            matched = page_re.match(filename)
+            if matched:
+                page_files[int(matched.group(1))] = path.join(tempdir, filename)
+
+        # some formula didn't produce a page, and pages can't be matched to formulas
+        if sorted(page_files) != list(range(1, len(batch) + 1)):
+            return []
+
+        rendered = []
+        for page, (_body, outfn) in enumerate(batch, 1):
+            ensuredir(path.dirname(outfn))
+            shutil.move(page_files[page], outfn)
+            rendered.append(outfn)
+        return rendered
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def render_pending_formulas(app, env):
+    builder = app.builder
+    if getattr(builder, 'math_renderer_name', None) != 'imgmath':
+        return
+
+    config = builder.config
+    # depths are read back from each image when using preview, so render one by one
+    if config.imgmath_image_format.lower() != 'svg' or config.imgmath_use_preview:
+        return
+
+    if tool_version(config.imgmath_latex) is None or tool_version(config.imgmath_dvisvgm) is None:
+        return
+
+    cache = getattr(app, 'imgmath_cache', None)
+    formulas = set()
+    for doc_formulas in getattr(env, 'imgmath_formulas', {}).values():
+        formulas.update(doc_formulas)
+
+    # group the formulas which still need rendering by document header
+    pending = {}
+    keys = {}
+    for math in sorted(formulas):
+        latex = imgmath.generate_latex_macro('svg', math, config, builder.confdir)
+        outfn = output_path(builder, latex, 'svg')
+        if path.isfile(outfn):
+            continue
+
+        key = None
+        if cache is not None:
+            key = cache_key(builder, latex, 'svg')
+            if key is not None and cache.restore(key, 'svg', outfn):
+                cache.record(b"h")
+                continue
+
+        parts = split_latex(latex)
+        if parts is None:
+            continue
+        header, body = parts
+        pending.setdefault(header, []).append((body, outfn))
+        keys[outfn] = key
+
+    if not pending:
+        return
+
+    workers = config.imgmath_batch_workers or os.cpu_count() or 1
+    total = sum(len(header_formulas) for header_formulas in pending.values())
+    # spread the formulas over all workers, with at most imgmath_batch_size per latex run
+    batch_size = max(1, min(config.imgmath_batch_size, -(-total // workers)))
+
+    batches = []
+    for header, header_formulas in pending.items():
+        for i in range(0, len(header_formulas), batch_size):
+            batches.append((header, header_formulas[i:i + batch_size]))
+
+    logger.info(__("rendering %d formulas in %d batches... "), total, len(batches), nonl=True)
+    rendered_count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda batch: render_batch(config, *batch), batches)
+        for rendered in results:
+            rendered_count += len(rendered)
+            for outfn in rendered:
+                key = keys[outfn]
+                if cache is not None and key is not None:
+                    cache.record(b"m")
+                    cache.store(key, 'svg', outfn)
+    logger.info(__("%d rendered"), rendered_count)
+
+
+def setup(app):
+    app.setup_extension("sphinx.ext.imgmath")
+
+    # the maximum number of formulas rendered by a single latex run
+    app.add_config_value("imgmath_batch_size", 64, "")
+    # how many latex runs can happen at the same time, defaults to the cpu count
+    app.add_config_value("imgmath_batch_workers", None, "")
+
+    app.connect("doctree-read", collect_formulas)
+    app.connect("env-purge-doc", env_purge_doc)
+    app.connect("env-merge-info", env_merge_info)
+    app.connect("env-updated", render_pending_formulas)
+
+    return {
+        'version': '0.1',
+        'env_version': 1,
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
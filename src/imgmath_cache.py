@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+"""
+Persistent, content-addressed cache for sphinx.ext.imgmath.
+
+imgmath names rendered formulas after the hash of their LaTeX source, but only
+looks for them in the output directory of the current build. This extension keeps
+a copy of every rendered formula in imgmath_cache_dir, keyed by the LaTeX source
+(formula, preamble and font size), the image format, the converter arguments and
+the versions of latex and dvisvgm / dvipng, so that all languages and build
+directories can reuse each other's renders.
+"""
+
+import os
+import shutil
+import subprocess
+from functools import lru_cache
+from hashlib import sha1, sha256
+from os import path
+
+import sphinx.ext.imgmath as imgmath
+from sphinx.locale import __
+from sphinx.util import logging
+from sphinx.util.osutil import ensuredir
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def tool_version(command):
+    """the first line of `command --version`, or None if the tool can't be run"""
+    try:
+        output = subprocess.run([command, "--version"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    lines = output.decode(errors="replace").splitlines()
+    return lines[0] if lines else ""
+
+
+class MathCache:
+    """
+    rendered formulas are stored as <cache_dir>/<key[:2]>/<key>.<format>.
+    hits and misses are appended as single bytes to a log file shared by all the
+    processes of a build, as parallel writers don't report back to the main process.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.stats_path = path.join(cache_dir, "stats-%d.log" % os.getpid())
+
+    def entry_path(self, key, image_format):
+        return path.join(self.cache_dir, key[:2], "%s.%s" % (key, image_format))
+
+    def record(self, event):
+        try:
+            with open(self.stats_path, "ab") as fp:
+                fp.write(event)
+        except OSError:
+            pass
+
+    def restore(self, key, image_format, outfn):
+        """copy a cached render to outfn, returning whether it was found"""
+        entry = self.entry_path(key, image_format)
+        try:
+            ensuredir(path.dirname(outfn))
+            shutil.copyfile(entry, outfn)
+            # keep recently used entries from being evicted
+            os.utime(entry)
+        except OSError:
+            # missing, or evicted by a concurrent build
+            return False
+        return True
+
+    def store(self, key, image_format, outfn):
+        entry = self.entry_path(key, image_format)
+        tmp_entry = "%s.%d.tmp" % (entry, os.getpid())
+        try:
+            ensuredir(path.dirname(entry))
+            shutil.copyfile(outfn, tmp_entry)
+            # other builds may be reading the cache at the same time
+            os.replace(tmp_entry, entry)
+        except OSError as exc:
+            logger.warning(__("could not store %s in the math cache: %s"), outfn, exc)
+
+    def read_stats(self):
+        """return the (hits, misses) of this build, and forget about them"""
+        try:
+            with open(self.stats_path, "rb") as fp:
+                events = fp.read()
+            os.unlink(self.stats_path)
+        except OSError:
+            return 0, 0
+        return events.count(b"h"), events.count(b"m")
+
+    def evict(self):
+        """remove the least recently used entries until the cache fits in max_size"""
+        entries = []
+        total_size = 0
+        for dirpath, _dirnames, filenames in os.walk(self.cache_dir):
+            if dirpath == self.cache_dir:
+                continue
+            for filename in filenames:
+                entry = path.join(dirpath, filename)
+                try:
+                    stat = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry))
+                total_size += stat.st_size
+
+        entries.sort()
+        evicted = 0
+        for _mtime, size, entry in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(entry)
+            except OSError:
+                continue
+            total_size -= size
+            evicted += 1
+        return evicted
+
+
+def cache_key(builder, latex, image_format):
+    config = builder.config
+    if image_format == "png":
+        converter = config.imgmath_dvipng
+        converter_args = config.imgmath_dvipng_args
+    else:
+        converter = config.imgmath_dvisvgm
+        converter_args = config.imgmath_dvisvgm_args
+
+    latex_version = tool_version(config.imgmath_latex)
+    converter_version = tool_version(converter)
+    if latex_version is None or converter_version is None:
+        return None
+
+    parts = [
+        latex,
+        image_format,
+        repr(config.imgmath_use_preview),
+        repr(list(config.imgmath_latex_args)),
+        repr(list(converter_args)),
+        latex_version,
+        converter_version,
+    ]
+    return sha256("\0".join(parts).encode()).hexdigest()
+
+
+def output_path(builder, latex, image_format):
+    """the path imgmath renders latex to inside the build directory"""
+    filename = "%s.%s" % (sha1(latex.encode()).hexdigest(), image_format)
+    return path.join(builder.outdir, builder.imagedir, "math", filename)
+
+
+uncached_render_math = imgmath.render_math
+
+
+def render_math(self, math):
+    """imgmath.render_math, looking up the shared cache before running latex"""
+    cache = getattr(self.builder.app, "imgmath_cache", None)
+    if cache is None:
+        return uncached_render_math(self, math)
+
+    image_format = self.builder.config.imgmath_image_format.lower()
+    if image_format not in imgmath.SUPPORT_FORMAT:
+        return uncached_render_math(self, math)
+
+    latex = imgmath.generate_latex_macro(image_format, math,
+                                         self.builder.config, self.builder.confdir)
+    outfn = output_path(self.builder, latex, image_format)
+    if path.isfile(outfn):
+        return uncached_render_math(self, math)
+
+    key = cache_key(self.builder, latex, image_format)
+    if key is None:
+        return uncached_render_math(self, math)
+
+    if cache.restore(key, image_format, outfn):
+        cache.record(b"h")
+        return uncached_render_math(self, math)
+
+    cache.record(b"m")
+    relfn, depth = uncached_render_math(self, math)
+    if relfn is not None:
+        cache.store(key, image_format, outfn)
+    return relfn, depth
+
+
+def init_cache(app):
+    cache_dir = app.config.imgmath_cache_dir
+    if not cache_dir:
+        return
+
+    cache_dir = path.join(app.confdir, cache_dir)
+    ensuredir(cache_dir)
+    app.imgmath_cache = MathCache(cache_dir, app.config.imgmath_cache_size)
+
+
+def report_stats(app, exc):
+    cache = getattr(app, "imgmath_cache", None)
+    if cache is None:
+        return
+
+    hits, misses = cache.read_stats()
+    evicted = cache.evict()
+    if hits or misses or evicted:
+        logger.info(__("math cache: %d hits, %d misses, %d evicted"), hits, misses, evicted)
+
+
+def setup(app):
+    app.setup_extension("sphinx.ext.imgmath")
+    imgmath.render_math = render_math
+
+    # where rendered formulas are kept, relative to the configuration directory
+    app.add_config_value("imgmath_cache_dir", None, "")
+    # in bytes, least recently used formulas are evicted past this size
+    app.add_config_value("imgmath_cache_size", 64 * 1024 * 1024, "")
+
+    app.connect("builder-inited", init_cache)
+    app.connect("build-finished", report_stats)
+
+    return {
+        'version': '0.1',
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
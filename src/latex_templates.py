@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+Loads the LaTeX preamble templates only for the builders which use them.
+
+latex_templates maps latex_elements keys to the name of a template in
+latex_templates_dir, whose $variables are substituted with configuration values,
+and imgmath_latex_preamble_template names the preamble of inline math, which is
+used verbatim. The LaTeX builder gets the former, and the HTML builders the
+latter, when they are initialized: other builders, such as gettext, never read
+them. Keys set explicitly in latex_elements or imgmath_latex_preamble win.
+
+Rendered templates are kept for the life of the process, by digest of the file
+and of the substituted values, so that builds running one after the other only
+render the templates which were edited in between.
+"""
+
+from hashlib import sha256
+from os import path
+from string import Template
+
+from sphinx.builders.html import StandaloneHTMLBuilder
+from sphinx.builders.latex import LaTeXBuilder
+from sphinx.errors import ConfigError
+from sphinx.locale import __
+
+# rendered templates, by (digest of the source, substituted values)
+rendered_templates = {}
+
+
+def template_identifiers(template):
+    """the names of the variables used by a string.Template"""
+    names = set()
+    for match in template.pattern.finditer(template.template):
+        name = match.group("named") or match.group("braced")
+        if name is not None:
+            names.add(name)
+    return sorted(names)
+
+
+def read_template(app, name, substitute):
+    filename = path.join(app.confdir, app.config.latex_templates_dir, name + ".tex")
+    with open(filename, "rb") as fp:
+        source = fp.read()
+
+    values = ()
+    if substitute:
+        template = Template(source.decode())
+        try:
+            values = tuple((identifier, str(app.config[identifier]))
+                           for identifier in template_identifiers(template))
+        except AttributeError as exc:
+            raise ConfigError(__("%s uses an unknown configuration value: %s")
+                              % (filename, exc)) from exc
+
+    key = (sha256(source).hexdigest(), values)
+    if key not in rendered_templates:
+        if substitute:
+            rendered_templates[key] = template.substitute(dict(values))
+        else:
+            rendered_templates[key] = source.decode()
+    return rendered_templates[key]
+
+
+def load_templates(app):
+    config = app.config
+    builder = app.builder
+
+    if isinstance(builder, LaTeXBuilder):
+        # the builder copied latex_elements into its context when initialized
+        for element, name in config.latex_templates.items():
+            if element not in config.latex_elements:
+                builder.context[element] = read_template(app, name, substitute=True)
+
+    elif isinstance(builder, StandaloneHTMLBuilder):
+        name = config.imgmath_latex_preamble_template
+        if name is not None and not config.imgmath_latex_preamble:
+            config.imgmath_latex_preamble = read_template(app, name, substitute=False)
+            # the preamble changes the rendered formulas, so it must be part of
+            # the configuration hash which decides whether pages are outdated
+            builder.build_info = builder.create_build_info()
+
+
+def setup(app):
+    app.setup_extension("sphinx.ext.imgmath")
+
+    # where templates are looked up, relative to the configuration directory
+    app.add_config_value("latex_templates_dir", "latex", "")
+    # maps latex_elements keys to the name of their template
+    app.add_config_value("latex_templates", {}, "")
+    # the name of the template used as imgmath_latex_preamble
+    app.add_config_value("imgmath_latex_preamble_template", None, "")
+
+    app.connect("builder-inited", load_templates)
+
+    return {
+        'version': '0.1',
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
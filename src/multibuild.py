@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Builds several formats of the book from a single read of the sources.
+
+`sphinx-build -M FORMAT` reads the sources into BUILDDIR/doctrees, which later
+formats reuse when run one after the other. Builders pickle the environment back
+when they re-read a document, so concurrent builds can't share that directory.
+Instead, the sources are read once by the dummy builder, which writes nothing but
+the environment, and every format is then written by its own sphinx-build
+process from a private copy of it, in BUILDDIR/doctrees-FORMAT.
+
+Extensions must keep the data they store in the environment independent of the
+builder reading the sources, as that builder isn't the one writing them.
+
+Usage: multibuild.py [-j JOBS] SOURCEDIR BUILDDIR FORMAT... [-- SPHINXOPTS...]
+"""
+
+import argparse
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+READ_BUILDER = "dummy"
+
+
+def sphinx_build(args, log_path):
+    """run sphinx-build, logging its output to log_path"""
+    command = [os.environ.get("SPHINXBUILD", "sphinx-build"), *args]
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with log_path.open("wb") as log:
+        returncode = subprocess.call(command, stdin=subprocess.DEVNULL,
+                                     stdout=log, stderr=subprocess.STDOUT)
+    if returncode != 0:
+        raise RuntimeError("sphinx-build %s failed, see %s" % (" ".join(args[:2]), log_path))
+
+
+def doctree_dir(builddir, output_format=None):
+    if output_format is None:
+        return builddir / "doctrees"
+    return builddir / ("doctrees-%s" % output_format)
+
+
+def read_sources(sourcedir, builddir, options=()):
+    """read the sources into the shared environment, in BUILDDIR/doctrees"""
+    sphinx_build(["-M", READ_BUILDER, str(sourcedir), str(builddir), *options],
+                 builddir / ("%s.log" % READ_BUILDER))
+
+
+def write_format(sourcedir, builddir, output_format, options=()):
+    """write output_format from a copy of the shared environment"""
+    private_dir = doctree_dir(builddir, output_format)
+    shutil.rmtree(private_dir, ignore_errors=True)
+    shutil.copytree(doctree_dir(builddir), private_dir)
+    sphinx_build(["-M", output_format, str(sourcedir), str(builddir),
+                  "-d", str(private_dir), *options],
+                 builddir / ("%s.log" % output_format))
+
+
+def build(sourcedir, builddir, formats, jobs=None, options=(), log=print):
+    """
+    read the sources once, then write all formats at the same time.
+    return the list of formats which failed.
+    """
+    try:
+        read_sources(sourcedir, builddir, options)
+    except RuntimeError as exc:
+        log(exc)
+        return list(formats)
+
+    failures = []
+
+    def write_job(output_format):
+        try:
+            write_format(sourcedir, builddir, output_format, options)
+            log("built %s" % output_format)
+        except RuntimeError as exc:
+            log(exc)
+            failures.append(output_format)
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        list(executor.map(write_job, formats))
+    return failures
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # everything after -- is passed to sphinx-build
+    options = []
+    if "--" in argv:
+        separator = argv.index("--")
+        argv, options = argv[:separator], argv[separator + 1:]
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of formats written at the same time, defaults to the cpu count")
+    parser.add_argument("sourcedir", metavar="SOURCEDIR", type=pathlib.Path)
+    parser.add_argument("builddir", metavar="BUILDDIR", type=pathlib.Path)
+    parser.add_argument("formats", metavar="FORMAT", nargs="+")
+    args = parser.parse_args(argv)
+
+    failures = build(args.sourcedir, args.builddir, args.formats, args.jobs, options,
+                     log=lambda message: print(message, flush=True))
+    if failures:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+/*
+ * search_shards.js
+ * ~~~~~~~~~~~~~~~~
+ *
+ * Loads the shards of the search index a query needs, see search_shards.py.
+ * searchindex.js only has the documents, titles and objects, and the digest
+ * of the _search/ shard holding the terms of every prefix.
+ */
+
+(function () {
+  var setIndex = Search.setIndex;
+  var query = Search.query;
+  // shards which were loaded, by prefix
+  var shards = {};
+  // callbacks waiting for a shard, by prefix
+  var loading = {};
+
+  function shardUrl(prefix) {
+    var name = "";
+    for (var i = 0; i < prefix.length; i++) {
+      name += ("000" + prefix.charCodeAt(i).toString(16)).slice(-4);
+    }
+    return DOCUMENTATION_OPTIONS.URL_ROOT + "_search/" + name + ".js";
+  }
+
+  // prefixes whose shard was fetched again, bypassing the cache
+  var refetched = {};
+
+  function fetchShard(prefix, url) {
+    var script = document.createElement("script");
+    script.src = url;
+    // search what was loaded rather than never finishing
+    script.onerror = function () {
+      Search.setShard(prefix, null, {terms: {}, titleterms: {}});
+    };
+    document.head.appendChild(script);
+  }
+
+  // digest is the one of the manifest, or undefined before it is loaded
+  function loadShard(prefix, digest, callback) {
+    var shard = shards[prefix];
+    if (shard !== undefined && (digest === undefined || shard.digest === digest
+                                || refetched[prefix])) {
+      callback();
+      return;
+    }
+
+    // check the digest of the shard once it is there
+    var check = function () {
+      loadShard(prefix, digest, callback);
+    };
+    if (loading[prefix] !== undefined) {
+      loading[prefix].push(check);
+      return;
+    }
+    loading[prefix] = [check];
+    if (shard === undefined) {
+      fetchShard(prefix, shardUrl(prefix));
+    } else {
+      // a shard of an earlier build was cached, get the current one
+      refetched[prefix] = true;
+      fetchShard(prefix, shardUrl(prefix) + "?v=" + digest);
+    }
+  }
+
+  // the prefixes of the words of a query and of their stems, which may be
+  // more than the ones the search uses
+  function queryPrefixes(query, prefixLength) {
+    var stemmer = new Stemmer();
+    var prefixes = [];
+    splitQuery(query).forEach(function (word) {
+      word = word.toLowerCase().replace(/^-/, "");
+      [word, stemmer.stemWord(word)].forEach(function (term) {
+        var prefix = term.substr(0, prefixLength);
+        if (prefix !== "" && prefixes.indexOf(prefix) == -1) {
+          prefixes.push(prefix);
+        }
+      });
+    });
+    return prefixes;
+  }
+
+  Search.setIndex = function (index) {
+    // filled with the shards used by queries
+    index.terms = {};
+    index.titleterms = {};
+    setIndex.call(this, index);
+  };
+
+  Search.setShard = function (prefix, digest, shard) {
+    shards[prefix] = {digest: digest, shard: shard};
+    var callbacks = loading[prefix] || [];
+    delete loading[prefix];
+    callbacks.forEach(function (callback) {
+      callback();
+    });
+  };
+
+  Search.query = function (q) {
+    var self = this;
+    var index = this._index;
+    var prefixes = queryPrefixes(q, index.shardprefixlength).filter(function (prefix) {
+      return index.shards[prefix] !== undefined;
+    });
+    var pending = prefixes.length + 1;
+    function done() {
+      if (--pending === 0) {
+        prefixes.forEach(function (prefix) {
+          $.extend(index.terms, shards[prefix].shard.terms);
+          $.extend(index.titleterms, shards[prefix].shard.titleterms);
+        });
+        query.call(self, q);
+      }
+    }
+    prefixes.forEach(function (prefix) {
+      loadShard(prefix, index.shards[prefix], done);
+    });
+    done();
+  };
+
+  // the manifest isn't needed to know the shards of the query in the page
+  // address, so they are fetched along with it
+  var params = $.getQueryParameters();
+  var prefixLength = Number(document.currentScript.dataset.prefixLength);
+  if (params.q) {
+    queryPrefixes(params.q[0], prefixLength).forEach(function (prefix) {
+      loadShard(prefix, undefined, function () {});
+    });
+  }
+})();
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+Splits the search index of the html book into shards, loaded as queries need them.
+
+The stock searchindex.js holds every term of the book, which the search page
+downloads and parses before showing any result. With search_shards set, the
+terms and title terms are split by their first search_shards_prefix_length
+characters into _search/<prefix>.js files, named after the UTF-16 code units of
+the prefix in hex, and searchindex.js becomes a manifest with the documents,
+titles and objects, and the digest of every shard.
+
+search_shards.js, written to _static and added to the search page, loads the
+shards of the words of the query in the page address, and of their stems, along
+with the manifest rather than after it, so that the first results only wait
+for one round trip. Shards whose digest doesn't match the manifest come from
+an earlier build, and are fetched again. Partial matches are only found among
+the terms of the loaded shards, which share a prefix with the query.
+
+Sphinx keeps reading and writing the whole index, which incremental builds start
+from, as .searchindex.js: hidden files aren't deployed.
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+from collections import defaultdict
+from os import path
+
+from sphinx.builders.html import JavaScript, StandaloneHTMLBuilder
+from sphinx.builders.singlehtml import SingleFileHTMLBuilder
+from sphinx.locale import __
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+SHARDS_DIR = "_search"
+FULL_INDEX_FILENAME = ".searchindex.js"
+SCRIPT = "search_shards.js"
+script_path = path.join(path.dirname(path.abspath(__file__)), SCRIPT)
+
+
+def uses_shards(app):
+    builder = app.builder
+    # singlehtml has no search page, and epub no search at all
+    return (app.config.search_shards and isinstance(builder, StandaloneHTMLBuilder)
+            and not isinstance(builder, SingleFileHTMLBuilder) and builder.search)
+
+
+def keep_full_index(app):
+    if uses_shards(app):
+        app.builder.searchindex_filename = FULL_INDEX_FILENAME
+
+
+def dumps(data):
+    """compact JSON, which is valid JavaScript"""
+    return json.dumps(data, separators=(",", ":"), sort_keys=True)
+
+
+def shard_filename(prefix):
+    # as search_shards.js names them, from the UTF-16 code units of the prefix
+    units = prefix.encode("utf-16-be")
+    return "".join("%02x" % unit for unit in units) + ".js"
+
+
+def split_index(index, prefix_length):
+    """split the terms of a frozen index by prefix, returning the manifest and shards"""
+    manifest = {key: value for key, value in index.items()
+                if key not in ("terms", "titleterms")}
+    shards = defaultdict(lambda: {"terms": {}, "titleterms": {}})
+    for key in ("terms", "titleterms"):
+        for term, documents in index[key].items():
+            shards[term[:prefix_length]][key][term] = documents
+    return manifest, dict(shards)
+
+
+def write_if_changed(filename, data):
+    try:
+        with open(filename, encoding="utf-8") as fp:
+            if fp.read() == data:
+                return
+    except OSError:
+        pass
+    with open(filename + ".tmp", "w", encoding="utf-8") as fp:
+        fp.write(data)
+    os.replace(filename + ".tmp", filename)
+
+
+def write_shards(app, exception):
+    if exception is not None or not uses_shards(app):
+        return
+
+    builder = app.builder
+    static_dir = path.join(builder.outdir, "_static")
+    os.makedirs(static_dir, exist_ok=True)
+    shutil.copyfile(script_path, path.join(static_dir, SCRIPT))
+
+    # the indexer is only created when documents are written
+    if builder.indexer is None:
+        return
+
+    prefix_length = app.config.search_shards_prefix_length
+    manifest, shards = split_index(builder.indexer.freeze(), prefix_length)
+
+    shards_dir = path.join(builder.outdir, SHARDS_DIR)
+    os.makedirs(shards_dir, exist_ok=True)
+    manifest["shardprefixlength"] = prefix_length
+    manifest["shards"] = {}
+    for prefix, shard in sorted(shards.items()):
+        data = dumps(shard)
+        digest = hashlib.sha256(data.encode()).hexdigest()[:16]
+        manifest["shards"][prefix] = digest
+        write_if_changed(path.join(shards_dir, shard_filename(prefix)),
+                         "Search.setShard(%s,%s,%s)" % (dumps(prefix), dumps(digest), data))
+
+    used = {shard_filename(prefix) for prefix in shards}
+    for filename in os.listdir(shards_dir):
+        if filename not in used:
+            os.remove(path.join(shards_dir, filename))
+
+    write_if_changed(path.join(builder.outdir, StandaloneHTMLBuilder.searchindex_filename),
+                     "Search.setIndex(%s)" % dumps(manifest))
+    logger.info(__("search index split into %d shards"), len(shards))
+
+
+def add_script(app, pagename, templatename, context, doctree):
+    # searchtools.js is included after the scripts of the page, which must run
+    # after it, but before the manifest which is deferred as well
+    if pagename == "search" and uses_shards(app):
+        # the prefix length lets the script fetch shards before the manifest
+        prefix_length = str(app.config.search_shards_prefix_length)
+        script = JavaScript(posixpath.join("_static", SCRIPT), defer="defer",
+                            **{"data-prefix-length": prefix_length})
+        # a new list, as app.add_js_file would also add it to the pages written
+        # after this one, and to the next builds of the same application
+        context["script_files"] = list(context["script_files"]) + [script]
+
+
+def setup(app):
+    # split the search index into shards, loaded as queries need them
+    app.add_config_value("search_shards", False, "html")
+    # the number of leading characters of the terms which are grouped in a shard
+    app.add_config_value("search_shards_prefix_length", 1, "html")
+
+    app.connect("builder-inited", keep_full_index)
+    app.connect("html-page-context", add_script)
+    app.connect("build-finished", write_shards)
+
+    return {
+        'version': '0.1',
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""
+Serves the html book, rebuilding it as its sources change.
+
+The book is built into BUILDDIR/html from the doctrees of BUILDDIR/doctrees, as
+`make html` does, by a Sphinx application which is kept along with its
+environment between builds, so that a change only reads and writes the documents
+it affects. Sources are polled for changes:
+
+ - .rst, .bib and the .js files of the extensions: the book is built again
+ - static files: the book is built again, and the static files copied
+ - the illustrations: outdated assets are built by build_assets.py, then the
+   book, which picks up the images which changed
+ - the LaTeX templates: the application is created again, as these are read
+   when its builder is initialized
+ - conf.py and the extensions: the server restarts
+
+Served pages get a script which reloads them when a build finishes.
+
+Usage: serve.py [--bind ADDRESS] [--port PORT] SOURCEDIR BUILDDIR [-- SPHINXOPTS...]
+"""
+
+import argparse
+import contextlib
+import functools
+import http.server
+import os
+import pathlib
+import sys
+import threading
+import time
+
+from sphinx.application import Sphinx
+from sphinx.cmd.build import get_parser, handle_exception
+from sphinx.util.docutils import docutils_namespace, patch_docutils
+
+import build_assets
+
+# seconds between two scans of the sources
+POLL_INTERVAL = 0.1
+# editors may save several files at once, or in several steps
+SETTLE_DELAY = 0.05
+# seconds between two keepalive messages sent to the open pages
+KEEPALIVE_INTERVAL = 15
+
+RELOAD_PATH = "/_reload"
+RELOAD_SCRIPT = (b'<script>new EventSource("%s").onmessage = function () '
+                 b'{ location.reload(); };</script>' % RELOAD_PATH.encode())
+
+# kinds of changes, from the one doing the least to the one doing the most
+BOOK, STATIC, ASSETS, CONFIG, RESTART = range(5)
+
+
+class ReloadNotifier:
+    """counts the finished builds, which the open pages wait for"""
+    def __init__(self):
+        self.generation = 0
+        self.condition = threading.Condition()
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """wait for a build finishing after generation, returning the current one"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+
+class RequestHandler(http.server.SimpleHTTPRequestHandler):
+    """serves the build directory, adding the reload script to pages"""
+    def __init__(self, *args, notifier, **kwargs):
+        self.notifier = notifier
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        if self.path == RELOAD_PATH:
+            self.send_reload_events()
+            return
+
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split("?", 1)[0].endswith("/"):
+            path = os.path.join(path, "index.html")
+        if path.endswith(".html") and os.path.isfile(path):
+            self.send_page(path)
+            return
+        super().do_GET()
+
+    def send_page(self, path):
+        with open(path, "rb") as fp:
+            content = fp.read()
+        body_end = content.rfind(b"</body>")
+        if body_end != -1:
+            content = content[:body_end] + RELOAD_SCRIPT + content[body_end:]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_reload_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        generation = self.notifier.generation
+        try:
+            while True:
+                current = self.notifier.wait(generation, KEEPALIVE_INTERVAL)
+                if current == generation:
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    self.wfile.write(b"data: reload\n\n")
+                    generation = current
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the page was closed or reloaded
+            pass
+
+    def log_message(self, format, *args):
+        # keep the output for the builds
+        pass
+
+
+def parse_confoverrides(parser, args):
+    """the configuration values set by -D, -A and -n, as sphinx-build does"""
+    overrides = {}
+    for definition in args.define:
+        if "=" not in definition:
+            parser.error("-D option argument must be in the form name=value")
+        key, value = definition.split("=", 1)
+        overrides[key] = value
+    for definition in args.htmldefine:
+        if "=" not in definition:
+            parser.error("-A option argument must be in the form name=value")
+        key, value = definition.split("=", 1)
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+        overrides["html_context.%s" % key] = value
+    if args.nitpicky:
+        overrides["nitpicky"] = True
+    return overrides
+
+
+class BookBuilder:
+    """a Sphinx application kept between builds, created again when it fails"""
+    def __init__(self, sourcedir, builddir, options):
+        parser = get_parser()
+        self.args = parser.parse_args(
+            ["-b", "html", "-d", str(builddir / "doctrees"), *options,
+             str(sourcedir), str(builddir / "html")])
+        self.outdir = pathlib.Path(self.args.outputdir)
+        self.confoverrides = parse_confoverrides(parser, self.args)
+        self.app = None
+        self.app_context = None
+        self.freshenv = self.args.freshenv
+        self.force_all = self.args.force_all
+
+    def discard_app(self):
+        if self.app_context is not None:
+            self.app_context.close()
+        self.app = None
+        self.app_context = None
+
+    def create_app(self):
+        self.discard_app()
+        status = None if self.args.quiet or self.args.really_quiet else sys.stdout
+        warning = None if self.args.really_quiet else sys.stderr
+
+        # directives are registered globally, and restored when the app is discarded
+        self.app_context = contextlib.ExitStack()
+        self.app_context.enter_context(patch_docutils(self.args.sourcedir))
+        self.app_context.enter_context(docutils_namespace())
+        self.app = Sphinx(self.args.sourcedir, self.args.sourcedir, self.args.outputdir,
+                          self.args.doctreedir, self.args.builder, self.confoverrides,
+                          status, warning, self.freshenv, self.args.warningiserror,
+                          self.args.tags, self.args.verbosity, self.args.jobs,
+                          self.args.keep_going)
+        self.freshenv = False
+
+    def build(self, copy_static=False):
+        """build the book, returning whether it succeeded"""
+        try:
+            if self.app is None:
+                self.create_app()
+            self.app.build(self.force_all)
+            # the html builder only copies them after writing documents
+            if copy_static:
+                self.app.builder.copy_static_files()
+        except (Exception, KeyboardInterrupt) as exc:
+            handle_exception(self.app, self.args, exc, sys.stderr)
+            if isinstance(exc, KeyboardInterrupt):
+                raise
+            self.discard_app()
+            return False
+
+        self.force_all = False
+        return self.app.statuscode == 0
+
+
+def build_illustrations(log=print):
+    """build the outdated assets, returning the files they are built to"""
+    # sources may have changed since the previous build
+    build_assets.file_digest.cache_clear()
+    build_assets.tool_version.cache_clear()
+    build_assets.Asset.cache_key.cache_clear()
+
+    assets = build_assets.find_assets()
+    cache = build_assets.AssetCache(build_assets.default_cache_dir)
+    build_assets.build_assets(assets, cache=cache, log=log)
+    return {path for asset in assets for path in (asset.svg, asset.pdf) if path is not None}
+
+
+def watched_files(sourcedir, asset_outputs):
+    """map the sources of the book to the kind of change they make"""
+    files = {}
+    # extensions write their scripts, such as search_shards.js, after every build
+    for pattern, kind in (("*.rst", BOOK), ("*.bib", BOOK), ("*.js", BOOK), ("_static/*", STATIC),
+                          ("latex/*.tex", CONFIG), ("*.py", RESTART)):
+        for path in sourcedir.glob(pattern):
+            files[path] = kind
+
+    for path in build_assets.illustrations_dir.rglob("*"):
+        if path in asset_outputs or path.suffix == ".tmp" or not path.is_file():
+            continue
+        files[path] = ASSETS
+    return files
+
+
+def snapshot(files):
+    mtimes = {}
+    for path in files:
+        try:
+            mtimes[path] = path.stat().st_mtime_ns
+        except OSError:
+            # removed since it was listed
+            pass
+    return mtimes
+
+
+def changed_files(previous, current):
+    return {path for path in previous.keys() | current.keys()
+            if previous.get(path) != current.get(path)}
+
+
+def restart():
+    print("restarting the server", flush=True)
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def watch(sourcedir, builder, notifier, asset_outputs):
+    files = watched_files(sourcedir, asset_outputs)
+    mtimes = snapshot(files)
+    while True:
+        time.sleep(POLL_INTERVAL)
+        current_files = watched_files(sourcedir, asset_outputs)
+        current = snapshot(current_files)
+        if current == mtimes:
+            continue
+
+        time.sleep(SETTLE_DELAY)
+        current_files = watched_files(sourcedir, asset_outputs)
+        current = snapshot(current_files)
+        changed = changed_files(mtimes, current)
+        kinds = {current_files.get(path, files.get(path)) for path in changed}
+        files, mtimes = current_files, current
+
+        start = time.perf_counter()
+        if RESTART in kinds:
+            restart()
+        if CONFIG in kinds:
+            builder.discard_app()
+        if ASSETS in kinds:
+            asset_outputs = build_illustrations()
+        if builder.build(copy_static=STATIC in kinds):
+            notifier.notify()
+        print("rebuilt in %.2fs after changes to %s" % (
+            time.perf_counter() - start,
+            ", ".join(sorted(str(path.relative_to(sourcedir)) for path in changed))), flush=True)
+
+        # the build may have written some of the sources, such as illustrations
+        files = watched_files(sourcedir, asset_outputs)
+        mtimes = snapshot(files)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # everything after -- is passed to Sphinx, as with sphinx-build
+    options = []
+    if "--" in argv:
+        separator = argv.index("--")
+        argv, options = argv[:separator], argv[separator + 1:]
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bind", default="", help="address to listen on, defaults to all")
+    parser.add_argument("--port", type=int, default=8000, help="defaults to %(default)s")
+    parser.add_argument("sourcedir", metavar="SOURCEDIR", type=pathlib.Path)
+    parser.add_argument("builddir", metavar="BUILDDIR", type=pathlib.Path)
+    args = parser.parse_args(argv)
+    sourcedir = args.sourcedir.resolve()
+
+    builder = BookBuilder(sourcedir, args.builddir, options)
+    asset_outputs = build_illustrations()
+    builder.build()
+
+    notifier = ReloadNotifier()
+    handler = functools.partial(RequestHandler, directory=str(builder.outdir),
+                                notifier=notifier)
+    server = http.server.ThreadingHTTPServer((args.bind, args.port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("serving %s on http://%s:%d/" % (builder.outdir, args.bind or "localhost", args.port),
+          flush=True)
+
+    try:
+        watch(sourcedir, builder, notifier, asset_outputs)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -30,10 +30,10 @@ OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
 DAMAGE.
 """
 
-import re
 from docutils import nodes
 import docutils.parsers.rst.directives as directives
 from docutils.parsers.rst import Directive
+from docutils.writers.html5_polyglot import HTMLTranslator as HTML5Translator
 from sphinx.directives.patches import Figure
 
 from typing import Any, Dict, List, Set, Tuple, TypeVar
@@ -45,10 +45,13 @@ from docutils.nodes import Element, Node
 from sphinx.application import Sphinx
 from sphinx.environment import BuildEnvironment
 from sphinx.environment.collectors import EnvironmentCollector
-from sphinx.locale import __
+from sphinx.errors import ExtensionError
+from sphinx.locale import _, __
 from sphinx.transforms import SphinxContentsFilter
 from sphinx.util import url_re, logging
 
+logger = logging.getLogger(__name__)
+
 class subfigure(nodes.figure):
     pass
 
@@ -58,40 +61,20 @@ def skip_visit(self, node):
 
 
 def visit_subfigure_tex(self, node):
-    self.__body = self.body
-    self.body = []
-    self.visit_figure(node)
+    # no newline before the subfigure, a newline between two subfigures means
+    # "stop stacking subfigures" on this line. if the node isn't the first, pad
+    if node["subfig_i"] != 0:
+        self.body.append(r"\hspace{\fill}")
+    self.body.append(r"\begin{subfigure}[t]{%s\linewidth}" % node["width"] + "\n")
+    self.body.append(r"\centering" + "\n")
+    self.context.append(r"\end{subfigure}" + "\n")
 
 
 def depart_subfigure_tex(self, node):
-    self.depart_figure(node)
-    figoutput = "".join(self.body)
-    # the newlines at the beginning mess up the subfigure alignment
-    # a newline between two subfigures means "stop stacking subfigures"
-    # on this line
-    figoutput = figoutput.lstrip("\n")
-
-    # if the node isn't the first, pad
-    if node["subfig_i"] != 0:
-        figoutput = r"\hspace{\fill}" + figoutput
-
-    # replace the start tag
-    base_output = r"\\begin{figure}\[[a-z]*\]"
-    replacement = r"\\begin{subfigure}[t]{%s\\linewidth}" % node["width"]
-    figoutput = re.sub(base_output, replacement, figoutput)
-    # replace the end tag
-    figoutput = figoutput.replace(r"\end{figure}", r"\end{subfigure}")
-    figoutput = figoutput.replace("\\capstart\n", "")
-    # figoutput = figoutput.replace(r"\centering", r"")
-    figoutput = figoutput.replace("\\noindent\n", "")
-    self.body = self.__body
-    self.body.append(figoutput)
+    self.body.append(self.context.pop())
 
 
 def visit_subfigure_html(self, node):
-    self.__body = self.body
-    self.body = []
-
     # change the way fignumbers are displayed inside subfigures
     def patched_add_fignumber(node):
         def append_fignumber(figtype, figure_id):
@@ -115,21 +98,24 @@ def visit_subfigure_html(self, node):
                 append_fignumber(figtype, node['ids'][0])
     self.__saved_add_fignumber = self.add_fignumber
     self.add_fignumber = patched_add_fignumber
-    self.visit_figure(node)
+
+    atts = {
+        "class": "subfigure",
+        "style": "width: %g%%" % (float(node["width"]) * 100),
+    }
+    if node.get("align"):
+        atts["class"] += " align-" + node["align"]
+    self.body.append(self.starttag(node, "div", **atts))
 
 
 def depart_subfigure_html(self, node):
-    self.depart_figure(node)
+    # the html5 writer opens a <figcaption> for the caption of figures, and
+    # leaves it to the figure to close it
+    if isinstance(self, HTML5Translator) and len(node) > 1:
+        self.body.append("</figcaption>\n")
+    self.body.append("</div>\n")
     self.add_fignumber = self.__saved_add_fignumber
 
-    figoutput = "".join(self.body)
-    figoutput = figoutput.replace(
-        'class="figure',
-        'style="width: %g%%" class="subfigure' % (float(node["width"]) * 100),
-    )
-    self.body = self.__body
-    self.body.append(figoutput)
-
 
 class SubfigureDirective(Figure):
     def run(self):
@@ -222,28 +208,25 @@ def doctree_read(app, doctree):
         figmatrix_id = node_id(figmatrix_node)
         subfig_i = 0
 
-        i = 0
-        # we can't use enumerate, as we delete nodes on the go
-        while i < len(figmatrix_node.children):
-            removed_nodes = 0
-            figure_node = figmatrix_node.children[i]
-            if isinstance(figure_node, subfigure):
-                if i > 0:
-                    # if the node before the figure is a target
-                    # move it inside the subfig
-                    prevnode = figmatrix_node.children[i - 1]
-                    if isinstance(prevnode, nodes.target):
-                        figmatrix_node.children.remove(prevnode)
-                        figure_node.insert(0, prevnode)
-                        removed_nodes += 1
-
-                figure_node["width"] = figmatrix_node["width"]
-                figure_node["subfig_i"] = subfig_i
-                doc_subfigures[node_id(figure_node)] = (figmatrix_id, subfig_i)
+        # rebuild the children in a single pass, rather than deleting nodes
+        # while walking them
+        children = []
+        for child in figmatrix_node.children:
+            if isinstance(child, subfigure):
+                # if the node before the figure is a target
+                # move it inside the subfig
+                if children and isinstance(children[-1], nodes.target):
+                    child.insert(0, children.pop())
+
+                child["width"] = figmatrix_node["width"]
+                child["subfig_i"] = subfig_i
+                doc_subfigures[node_id(child)] = (figmatrix_id, subfig_i)
                 subfig_i += 1
-            elif isinstance(figure_node, nodes.figure):
+            elif isinstance(child, nodes.figure):
                 raise ExtensionError(_("`figure' can't be used in figmatrix, use `subfigure'"))
-            i += 1 - removed_nodes
+            children.append(child)
+        figmatrix_node.children = children
+
 
 def env_purge_doc(app, env, docname):
     if not hasattr(env, 'subfigures'):
@@ -259,10 +242,28 @@ def env_merge_info(app, env, docnames, other) -> None:
     if not hasattr(env, 'subfigures'):
         env.subfigures = {}
 
-    env.subfigures.update(other.subfigures)
+    # other also holds a copy of the entries which were there when it was forked,
+    # only take the documents it actually read
+    for docname in docnames:
+        if docname in other.subfigures:
+            env.subfigures[docname] = other.subfigures[docname]
 
 
 class TocFixupCollector(EnvironmentCollector):
+    """
+    Numbers subfigures after their figmatrix: Figure 2.3 (a), Figure 2.3 (b), ...
+
+    env.subfigure_fignumbers maps a docname to the (sphinx, fixed) pair of subfigure
+    numbers of the last build. The numbers sphinx assigned are put back before
+    TocTreeCollector renumbers figures, as it would otherwise compare its own numbers
+    against the fixed ones and report every document with subfigures as changed.
+    """
+    def enable(self, app: Sphinx) -> None:
+        super().enable(app)
+        # run before TocTreeCollector.get_updated_docs
+        self.listener_ids['env-get-updated-early'] = app.connect(
+            'env-get-updated', self.restore_sphinx_numbers, priority=400)
+
     def clear_doc(self, app: Sphinx, env: BuildEnvironment, docname: str) -> None:
         pass
 
@@ -273,12 +274,20 @@ class TocFixupCollector(EnvironmentCollector):
     def process_doc(self, app: Sphinx, doctree: nodes.document) -> None:
         pass
 
+    def restore_sphinx_numbers(self, app: Sphinx, env: BuildEnvironment) -> List[str]:
+        for docname, (sphinx_numbers, _fixed_numbers) in getattr(env, 'subfigure_fignumbers', {}).items():
+            doc_fignumbers = env.toc_fignumbers.get(docname, None)
+            if doc_fignumbers is not None and "subfigure" in doc_fignumbers:
+                doc_fignumbers["subfigure"] = sphinx_numbers
+        return []
+
     def get_updated_docs(self, app: Sphinx, env: BuildEnvironment) -> List[str]:
-        updated_docs: Set[str] = set()
+        updated_docs: List[str] = []
+        old_subfigure_fignumbers = getattr(env, 'subfigure_fignumbers', {})
+        env.subfigure_fignumbers = {}
 
         # for each document, get the figure numners
         for docname, doc_fignumbers in env.toc_fignumbers.items():
-            updates = 0
             # skip the document if there are no subfigures
             doc_subfig_fignumbers = doc_fignumbers.get("subfigure", None)
             if doc_subfig_fignumbers is None:
@@ -288,17 +297,23 @@ class TocFixupCollector(EnvironmentCollector):
             if doc_fig_fignumbers is None:
                 continue
 
+            # toc_fignumbers is rebuilt from scratch by TocTreeCollector on each build,
+            # so the fixed numbers always have to be written back
+            sphinx_numbers = dict(doc_subfig_fignumbers)
             doc_subfigures = env.subfigures[docname]
             for subfigure_id, (figmatrix_id, subfig_i) in doc_subfigures.items():
                 figmatrix_fignumer = doc_fig_fignumbers[figmatrix_id]
                 subfig_letter = chr(ord("a") + subfig_i)
                 doc_subfig_fignumbers[subfigure_id] = figmatrix_fignumer + (subfig_letter,)
-                updates += 1
 
-            if updates:
-                updated_docs.add(docname)
+            env.subfigure_fignumbers[docname] = (sphinx_numbers, doc_subfig_fignumbers)
+
+            # only report documents whose final numbers changed
+            old_numbers = old_subfigure_fignumbers.get(docname, None)
+            if old_numbers is None or old_numbers[1] != doc_subfig_fignumbers:
+                updated_docs.append(docname)
 
-        return list(updated_docs)
+        return updated_docs
 
 
 def setup(app):
@@ -328,3 +343,9 @@ def setup(app):
     app.connect('env-purge-doc', env_purge_doc)
     app.connect('env-merge-info', env_merge_info)
     app.add_env_collector(TocFixupCollector)
+
+    return {
+        'version': '0.1',
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
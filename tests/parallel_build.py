@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Checks that parallel builds write the same files as serial builds.
+
+Every builder writes the book twice, from scratch, into a temporary directory:
+once serially, and once with -j JOBS. The outputs must be byte for byte
+identical, which catches extensions whose parallel reading or writing loses or
+reorders data, such as env_merge_info handlers. Differing, missing and extra
+files are listed, and the exit status is 1 when there are any.
+
+Usage: tests/parallel_build.py [-j JOBS] [-b BUILDER]... [-- SPHINXOPTS...]
+"""
+
+import argparse
+import filecmp
+import pathlib
+import subprocess
+import sys
+import tempfile
+
+project_root = pathlib.Path(__file__).resolve().parent.parent
+source_dir = project_root / "src"
+
+BUILDERS = ["html", "latex"]
+
+
+def build(builder, output_dir, options, jobs=None):
+    command = [sys.executable, "-m", "sphinx", "-b", builder, "-E", "-q",
+               "-d", str(output_dir / "doctrees"), *options]
+    if jobs is not None:
+        command.extend(["-j", str(jobs)])
+    command.extend([str(source_dir), str(output_dir / builder)])
+    subprocess.run(command, check=True, cwd=project_root)
+    return output_dir / builder
+
+
+def tree_files(root):
+    return {path.relative_to(root).as_posix()
+            for path in root.rglob("*") if path.is_file()}
+
+
+def compare_trees(serial_dir, parallel_dir):
+    """the files which differ, are missing from, or only in the parallel build"""
+    serial_files = tree_files(serial_dir)
+    parallel_files = tree_files(parallel_dir)
+    common = sorted(serial_files & parallel_files)
+    _match, mismatch, errors = filecmp.cmpfiles(serial_dir, parallel_dir, common, shallow=False)
+    return (sorted(mismatch + errors), sorted(serial_files - parallel_files),
+            sorted(parallel_files - serial_files))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # everything after -- is passed to Sphinx, as with sphinx-build
+    options = []
+    if "--" in argv:
+        separator = argv.index("--")
+        argv, options = argv[:separator], argv[separator + 1:]
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="number of processes of the parallel build, defaults to %(default)s")
+    parser.add_argument("-b", "--builder", dest="builders", action="append", choices=BUILDERS,
+                        help="builder to check, can be repeated, defaults to all of them")
+    args = parser.parse_args(argv)
+
+    failed = False
+    with tempfile.TemporaryDirectory(prefix="crypto101-parallel-") as tmp:
+        tmp = pathlib.Path(tmp)
+        for builder in args.builders or BUILDERS:
+            serial_dir = build(builder, tmp / "serial", options)
+            parallel_dir = build(builder, tmp / "parallel", options, args.jobs)
+            differing, missing, extra = compare_trees(serial_dir, parallel_dir)
+            for label, names in (("differs", differing), ("missing", missing),
+                                 ("extra", extra)):
+                for name in names:
+                    print("%s: %s %s" % (builder, label, name))
+            if differing or missing or extra:
+                failed = True
+            else:
+                print("%s: %d files identical with -j %d" % (
+                    builder, len(tree_files(serial_dir)), args.jobs))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Checks that only the search page loads search_shards.js, across rebuilds.
+
+The html book is built several times by the same Sphinx application, as
+`make serve` does, into a temporary directory. After every build, search.html
+must load the script exactly once, and the other pages not at all: a script
+added to the builder rather than to the page would pile up. Pages loading it a
+wrong number of times are listed, and the exit status is 1 when there are any.
+
+Usage: tests/search_script.py [--builds N]
+"""
+
+import argparse
+import io
+import pathlib
+import sys
+import tempfile
+
+from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace, patch_docutils
+
+project_root = pathlib.Path(__file__).resolve().parent.parent
+source_dir = project_root / "src"
+sys.path.insert(0, str(source_dir))
+
+import search_shards
+
+SCRIPT_TAG = 'src="_static/%s"' % search_shards.SCRIPT
+
+
+def wrong_pages(html_dir):
+    """the pages which don't load the script as many times as they should"""
+    pages = []
+    for page in sorted(html_dir.rglob("*.html")):
+        name = page.relative_to(html_dir).as_posix()
+        expected = 1 if name == "search.html" else 0
+        count = page.read_text(encoding="utf-8").count(SCRIPT_TAG)
+        if count != expected:
+            pages.append((name, count, expected))
+    return pages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--builds", type=int, default=3,
+                        help="number of builds of the same application, defaults to %(default)s")
+    args = parser.parse_args(argv)
+
+    failed = False
+    with tempfile.TemporaryDirectory(prefix="crypto101-search-script-") as tmp:
+        tmp = pathlib.Path(tmp)
+        html_dir = tmp / "html"
+        with patch_docutils(str(source_dir)), docutils_namespace():
+            app = Sphinx(str(source_dir), str(source_dir), str(html_dir),
+                         str(tmp / "doctrees"), "html", status=None, warning=io.StringIO())
+            for build in range(1, args.builds + 1):
+                # every page is written again, as after a change of the configuration
+                app.build(force_all=True)
+                pages = wrong_pages(html_dir)
+                for name, count, expected in pages:
+                    print("build %d: %s loads %s %d times instead of %d" % (
+                        build, name, search_shards.SCRIPT, count, expected))
+                if pages:
+                    failed = True
+                else:
+                    print("build %d: only search.html loads %s" % (build, search_shards.SCRIPT))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())